@@ -1,25 +1,44 @@
+import atexit
+import base64
+import calendar
+import collections
 import datetime
+import errno
+import hashlib
 import isodate
 import json
 import os
 import rawes
 import re
 import requests
+import shutil
+import sqlite3
 import sys
+import tempfile
+import threading
 import getopt
 import yaml
 import io
+import itertools
 import logging
+import math
+import multiprocessing
+import time
+import weakref
 
 from dateutil import tz
 from dateutil.parser import parse
 
 from distutils.util import strtobool
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 from django.core import management
 from django.conf.urls import url
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.text import compress_sequence
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 
@@ -27,20 +46,26 @@ from pycsw import server
 from pycsw.core import config, metadata
 from pycsw.core import admin as pycsw_admin
 from pycsw.core.etree import etree
-from pycsw.core.repository import Repository
+from pycsw.core.repository import Repository, create_custom_sql_functions
 from pycsw.core.util import wkt2geom
 
 from mapproxy.config.config import load_default_config, load_config
 from mapproxy.config.spec import validate_options
 from mapproxy.config.validator import validate_references
 from mapproxy.config.loader import ProxyConfiguration, ConfigurationError
+from mapproxy.image.message import message_image
+from mapproxy.image.opts import ImageOptions
 from mapproxy.wsgiapp import MapProxyApp
 
 from shapely.geometry import box
 
-from six.moves.urllib_parse import urlparse, unquote as url_unquote
+import sqlalchemy
+from sqlalchemy.orm import create_session
+
+from six.moves.urllib_parse import urlparse, quote as url_quote, unquote as url_unquote
 
 from rawes.elastic_exception import ElasticException
+from rawes.encoders import encode_date_optional_time
 
 LOGGER = logging.getLogger(__name__)
 
@@ -54,6 +79,42 @@ SECRET_KEY = os.getenv('REGISTRY_SECRET_KEY', 'Make sure you create a good secre
 REGISTRY_MAPPING_PRECISION = os.getenv('REGISTRY_MAPPING_PRECISION', '500m')
 REGISTRY_SEARCH_URL = os.getenv('REGISTRY_SEARCH_URL', 'http://127.0.0.1:9200')
 REGISTRY_DATABASE_URL = os.getenv('REGISTRY_DATABASE_URL', 'sqlite:////tmp/registry.db')
+REGISTRY_DATABASE_POOL_SIZE = int(os.getenv('REGISTRY_DATABASE_POOL_SIZE', '5'))
+REGISTRY_DATABASE_MAX_OVERFLOW = int(os.getenv('REGISTRY_DATABASE_MAX_OVERFLOW', '10'))
+REGISTRY_DATABASE_POOL_RECYCLE = int(os.getenv('REGISTRY_DATABASE_POOL_RECYCLE', '3600'))
+REGISTRY_INDEX_BATCH_SIZE = int(os.getenv('REGISTRY_INDEX_BATCH_SIZE', '500'))
+REGISTRY_INDEX_BATCH_BYTES = int(os.getenv('REGISTRY_INDEX_BATCH_BYTES', str(5 * 1024 * 1024)))
+REGISTRY_SEARCH_POOL_SIZE = int(os.getenv('REGISTRY_SEARCH_POOL_SIZE', '10'))
+REGISTRY_SEARCH_VERSION_TTL = int(os.getenv('REGISTRY_SEARCH_VERSION_TTL', '300'))
+REGISTRY_CATALOGS_SYNC_INTERVAL = int(os.getenv('REGISTRY_CATALOGS_SYNC_INTERVAL', '60'))
+# Search responses cache: 'memory', 'sqlite:////path/to/file.db' to share it between processes, or empty.
+# A memory cache is only invalidated by indexing done in the same process, other processes
+# (web workers, load_records, reindex) keep serving their cached responses for up to the TTL.
+REGISTRY_SEARCH_CACHE = os.getenv('REGISTRY_SEARCH_CACHE', 'memory')
+REGISTRY_SEARCH_CACHE_TTL = int(os.getenv('REGISTRY_SEARCH_CACHE_TTL', '60'))
+REGISTRY_SEARCH_CACHE_SIZE = int(os.getenv('REGISTRY_SEARCH_CACHE_SIZE', '10000'))
+REGISTRY_SEARCH_CACHE_MAX_BYTES = int(os.getenv('REGISTRY_SEARCH_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# Seconds for Elasticsearch to make indexed documents searchable (its refresh interval).
+REGISTRY_SEARCH_CACHE_SETTLE = float(os.getenv('REGISTRY_SEARCH_CACHE_SETTLE', '1'))
+REGISTRY_SEARCH_BATCH_SIZE = int(os.getenv('REGISTRY_SEARCH_BATCH_SIZE', '50'))
+REGISTRY_HEATMAP_MAX_CELLS = int(os.getenv('REGISTRY_HEATMAP_MAX_CELLS', '100000'))
+# Documents sampled per shard for the a.text facet.
+REGISTRY_TEXT_FACET_SAMPLE_SIZE = int(os.getenv('REGISTRY_TEXT_FACET_SAMPLE_SIZE', '200'))
+REGISTRY_RECORD_CACHE_SIZE = int(os.getenv('REGISTRY_RECORD_CACHE_SIZE', '1000'))
+# Seconds a record, or the absence of one, is cached. Records changed by other processes are seen after that.
+REGISTRY_RECORD_CACHE_TTL = int(os.getenv('REGISTRY_RECORD_CACHE_TTL', '300'))
+REGISTRY_RECORD_CACHE_MISS_TTL = int(os.getenv('REGISTRY_RECORD_CACHE_MISS_TTL', '30'))
+REGISTRY_LAYER_BATCH_SIZE = int(os.getenv('REGISTRY_LAYER_BATCH_SIZE', '100'))
+REGISTRY_MAPPROXY_CACHE_SIZE = int(os.getenv('REGISTRY_MAPPROXY_CACHE_SIZE', '100'))
+# Tiles are only stored when a cache directory is given. Type is file, sqlite or mbtiles.
+REGISTRY_TILE_CACHE_DIR = os.getenv('REGISTRY_TILE_CACHE_DIR', '')
+REGISTRY_TILE_CACHE_TYPE = os.getenv('REGISTRY_TILE_CACHE_TYPE', 'file')
+REGISTRY_TILE_CACHE_MAX_BYTES = int(os.getenv('REGISTRY_TILE_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+REGISTRY_TILE_CACHE_EXPIRY = int(os.getenv('REGISTRY_TILE_CACHE_EXPIRY', '86400'))
+REGISTRY_TILE_CACHE_PRUNE_INTERVAL = int(os.getenv('REGISTRY_TILE_CACHE_PRUNE_INTERVAL', '300'))
+REGISTRY_THUMBNAIL_DIR = os.getenv('REGISTRY_THUMBNAIL_DIR', '/tmp/registry_thumbnails')
+REGISTRY_THUMBNAIL_MAX_AGE = int(os.getenv('REGISTRY_THUMBNAIL_MAX_AGE', '3600'))
+REGISTRY_THUMBNAIL_TIMEOUT = int(os.getenv('REGISTRY_THUMBNAIL_TIMEOUT', '30'))
 
 VCAP_SERVICES = os.environ.get('VCAP_SERVICES', None)
 
@@ -72,6 +133,15 @@ def vcaps_search_url(VCAP_SERVICES, registry_url):
 # Override REGISTRY_SEARCH_URL if VCAP_SERVICES is defined.
 REGISTRY_SEARCH_URL = vcaps_search_url(VCAP_SERVICES, REGISTRY_SEARCH_URL)
 
+# Keep-alive connections to Elasticsearch shared by every client in the process.
+ES_SESSION = requests.Session()
+ES_SESSION.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=REGISTRY_SEARCH_POOL_SIZE))
+ES_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=REGISTRY_SEARCH_POOL_SIZE))
+
+# Elasticsearch clients by url: (client, version, time the version was detected).
+ES_CLIENTS = {}
+ES_CLIENTS_LOCK = threading.Lock()
+
 TIMEZONE = tz.gettz('America/New_York')
 
 LOGGING = {
@@ -157,6 +227,32 @@ PYCSW = {
     },
 }
 
+
+def freeze_csw_config(config):
+    return tuple((section, tuple(sorted(options.items()))) for section, options in sorted(config.items()))
+
+
+# Read only pycsw context shared by every RegistryRepository.
+CSW_CONTEXT = config.StaticContext()
+
+# pycsw configurations of the read only and the transactional (CSW-T) modes, built once.
+# Requests get a copy with their own url, PYCSW itself is never changed.
+CSW_CONFIGS = {
+    False: freeze_csw_config(PYCSW),
+    True: freeze_csw_config(dict(PYCSW, manager=dict(PYCSW['manager'], transactions='true'))),
+}
+
+
+def csw_config(url, transactions=False):
+    """pycsw configuration of a request for url.
+    """
+    config = dict((section, dict(options)) for section, options in CSW_CONFIGS[transactions])
+    config['server']['url'] = url
+    config['metadata:main']['provider_url'] = url
+
+    return config
+
+
 MD_CORE_MODEL = {
     'typename': 'pycsw:CoreMetadata',
     'outputschema': 'http://pycsw.org/metadata',
@@ -244,17 +340,16 @@ def csw_view(request, catalog=None):
                 'REQUEST_URI': request.build_absolute_uri()})
 
     # pycsw prefers absolute urls, let's get them from the request.
-    url = request.build_absolute_uri()
-    PYCSW['server']['url'] = url
-    PYCSW['metadata:main']['provider_url'] = url
-
-    # Enable CSW-T when a catalog is defined in the
-    if catalog:
-        PYCSW['manager']['transactions'] = 'true'
-
-    csw = server.Csw(PYCSW, env)
+    # Enable CSW-T when a catalog is defined in the url.
+    csw = server.Csw(csw_config(request.build_absolute_uri(), transactions=bool(catalog)), env)
     status, content = csw.dispatch_wsgi()
     status_code = int(status[0:3])
+
+    # Records inserted during a CSW-T request are buffered, send them now.
+    repository = getattr(csw, 'repository', None)
+    if isinstance(repository, RegistryRepository):
+        repository.flush()
+
     response = HttpResponse(content,
                             content_type=csw.contenttype,
                             status=status_code,
@@ -272,6 +367,10 @@ def delete_index(catalog, es=None):
         message, status = 'Catalog {0} removed succesfully'.format(catalog), 200
     except ElasticException:
         message, status = 'Catalog does not exist!', 404
+    CATALOGS.discard(catalog)
+    MAPPING_CHECKS.discard_if(lambda key: True)
+    if SEARCH_CACHE:
+        SEARCH_CACHE.bump(catalog)
 
     return message, status
 
@@ -293,6 +392,10 @@ def record_to_dict(record):
         'layer_date': record.date_modified,
         'layer_originator': record.creator,
         'layer_identifier': record.identifier,
+        'layer_centroid': {
+            'lat': (min_y + max_y) / 2.0,
+            'lon': (min_x + max_x) / 2.0
+        },
         # 'rectangle': box(min_x, min_y, max_x, max_y),
         'layer_geoshape': {
             'type': 'envelope',
@@ -306,15 +409,11 @@ def record_to_dict(record):
 
 
 def check_index_exists(catalog, es=None):
-    if es is None:
-        es, version = es_connect(url=REGISTRY_SEARCH_URL)
+    if catalog in CATALOGS.names():
+        return True
 
-    result = False
-    indices = es.get('_aliases').keys()
-    if catalog in indices:
-        result = True
-
-    return result
+    # The catalog may have been created by another process since the last sync.
+    return catalog in CATALOGS.sync(es)
 
 
 def create_index(catalog, es=None, version=None):
@@ -323,17 +422,234 @@ def create_index(catalog, es=None, version=None):
 
     mapping = es_mapping(version)
     es.put(catalog, data=mapping)
+    CATALOGS.add(catalog)
+    MAPPING_CHECKS.discard_if(lambda key: True)
+    if SEARCH_CACHE:
+        SEARCH_CACHE.bump(catalog)
 
     return 'Catalog {0} created succesfully'.format(catalog)
 
 
+class LRUCache(object):
+    """Thread safe mapping holding at most `maxsize` entries, and at most `maxbytes`
+       bytes of values when given. The least recently used entry is evicted first,
+       entries older than `ttl` seconds are dropped when read.
+    """
+
+    def __init__(self, maxsize, ttl=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires, size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.bytes -= size
+                self.misses += 1
+                return default
+            self.entries[key] = (value, expires, size)
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value):
+        size = len(value) if self.maxbytes else 0
+        expires = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            self.discard_locked(key)
+            self.entries[key] = (value, expires, size)
+            self.bytes += size
+            while self.entries and self.full():
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def full(self):
+        if len(self.entries) > self.maxsize:
+            return True
+
+        return bool(self.maxbytes) and self.bytes > self.maxbytes
+
+    def discard(self, key):
+        with self.lock:
+            self.discard_locked(key)
+
+    def discard_locked(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def discard_if(self, predicate):
+        """Drop every entry whose key matches the predicate.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.discard_locked(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class CatalogCache(object):
+    """In-process set of catalog names mirroring the Elasticsearch indices.
+       Filled on first use, updated by create_index/delete_index and resynced by a
+       background thread every `interval` seconds (0 disables the thread).
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.catalogs = None
+        self.indices = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def sync(self, es=None):
+        if es is None:
+            es, _ = es_connect(url=REGISTRY_SEARCH_URL)
+
+        catalogs, indices = set(), {}
+        for index, value in es.get('_aliases').items():
+            # Reindexed catalogs are aliases of versioned indices.
+            names = sorted(value.get('aliases') or [index])
+            catalogs.update(names)
+            indices[index] = names[0]
+        with self.lock:
+            self.catalogs = catalogs
+            self.indices = indices
+
+        return catalogs
+
+    def catalog(self, index):
+        """Catalog name of an index as returned by Elasticsearch, the alias of a reindexed catalog.
+        """
+        if index not in self.indices:
+            try:
+                self.sync()
+            except (requests.exceptions.ConnectionError, ElasticException) as e:
+                LOGGER.warn('Catalog sync failed: %s', e)
+
+        return self.indices.get(index, index)
+
+    def names(self):
+        catalogs = self.catalogs
+        if catalogs is None:
+            catalogs = self.sync()
+            self.start()
+
+        return sorted(catalogs)
+
+    def add(self, catalog):
+        with self.lock:
+            if self.catalogs is not None:
+                self.catalogs = self.catalogs | set([catalog])
+
+    def discard(self, catalog):
+        with self.lock:
+            if self.catalogs is not None:
+                self.catalogs = self.catalogs - set([catalog])
+
+    def start(self):
+        with self.lock:
+            if not self.interval or self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name='registry-catalogs')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sync()
+            except (requests.exceptions.ConnectionError, ElasticException) as e:
+                LOGGER.warn('Catalog sync failed: %s', e)
+
+
+CATALOGS = CatalogCache(REGISTRY_CATALOGS_SYNC_INTERVAL)
+
+
 def es_connect(url):
-    es = rawes.Elastic(url)
-    version = es.get('')['version']['number']
+    """Return the process wide client for url and the cluster version.
+       Clients share the ES_SESSION connection pool. The version is detected once
+       and refreshed after REGISTRY_SEARCH_VERSION_TTL seconds or a connection error.
+    """
+    es, version, detected = ES_CLIENTS.get(url, (None, None, 0))
+    if es is not None and time.time() - detected < REGISTRY_SEARCH_VERSION_TTL:
+        return es, version
+
+    if es is None:
+        es = rawes.Elastic(url)
+        for connection in es.connection_pool.connections:
+            connection.session = ES_SESSION
+
+    try:
+        version = es.get('')['version']['number']
+    except requests.exceptions.ConnectionError:
+        es_disconnect(url)
+        raise
+
+    with ES_CLIENTS_LOCK:
+        ES_CLIENTS[url] = (es, version, time.time())
 
     return es, version
 
 
+def es_disconnect(url):
+    """Forget the client for url, the next es_connect detects the version again.
+    """
+    with ES_CLIENTS_LOCK:
+        ES_CLIENTS.pop(url, None)
+
+
+def es_major_version(url):
+    """Major version of the cluster at url, 2 when it cannot be detected.
+    """
+    try:
+        _, version = es_connect(url)
+    except (requests.exceptions.ConnectionError, ElasticException):
+        return 2
+
+    return int(version.split('.')[0])
+
+
+def es_scroll(index, body, size=500, scroll='1m'):
+    """Yield every hit of a search on index, one page at a time, through the scroll API.
+    """
+    es, _ = es_connect(url=REGISTRY_SEARCH_URL)
+    body = dict(body, size=size)
+    response = es[index].post('_search', params={'scroll': scroll}, data=body)
+    scroll_id = response.get('_scroll_id')
+
+    try:
+        while response['hits']['hits']:
+            for hit in response['hits']['hits']:
+                yield hit
+            response = es.post('_search/scroll', params={'scroll': scroll}, data=scroll_id)
+            scroll_id = response.get('_scroll_id', scroll_id)
+    finally:
+        try:
+            es.delete('_search/scroll', data=scroll_id)
+        except (ElasticException, requests.exceptions.ConnectionError):
+            pass
+
+
 def es_mapping(version):
     return {
         "mappings": {
@@ -344,19 +660,35 @@ def es_mapping(version):
                         "tree": "quadtree",
                         "precision": REGISTRY_MAPPING_PRECISION
                     },
+                    "layer_centroid": {
+                        "type": "geo_point"
+                    },
+                    "layer_originator": keyword_field(version),
+                    "layer_identifier": keyword_field(version),
                     "title": text_field(version, copy_to="alltext"),
                     "abstract": text_field(version, copy_to="alltext"),
-                    "alltext": text_field(version)
+                    "alltext": text_field(version, fielddata=True)
                 }
             }
         }
     }
 
 
-def text_field(version, **kwargs):
+def text_field(version, fielddata=False, **kwargs):
     field_def = {"type": "string", "index": "analyzed"}
-    if version == '5.0.0':
+    if int(version.split('.')[0]) >= 5:
         field_def = {"type": "text"}
+        # Analyzed strings load fielddata by default before 5.0.
+        if fielddata:
+            field_def["fielddata"] = True
+    field_def.update(kwargs)
+    return field_def
+
+
+def keyword_field(version, **kwargs):
+    field_def = {"type": "string", "index": "not_analyzed"}
+    if int(version.split('.')[0]) >= 5:
+        field_def = {"type": "keyword"}
     field_def.update(kwargs)
     return field_def
 
@@ -368,12 +700,65 @@ def parse_catalog_from_url(url):
     return catalog_slug
 
 
+# Repositories holding records not yet sent to Elasticsearch.
+PENDING_REPOSITORIES = weakref.WeakSet()
+
+# State of a pycsw repository per (database, table): engine, reflected table and queryables.
+REPOSITORY_TEMPLATES = {}
+REPOSITORY_TEMPLATES_LOCK = threading.Lock()
+
+
+def database_engine(database):
+    """Process wide engine of database, with a connection pool sized by REGISTRY_DATABASE_POOL_SIZE.
+       pycsw memoizes its engines by url in Repository._engines, so it uses this one too.
+    """
+    if database not in Repository._engines:
+        options = {}
+        # SQLite pools connections per thread and takes no pool size.
+        if not database.startswith('sqlite'):
+            options = {
+                'pool_size': REGISTRY_DATABASE_POOL_SIZE,
+                'max_overflow': REGISTRY_DATABASE_MAX_OVERFLOW,
+                'pool_recycle': REGISTRY_DATABASE_POOL_RECYCLE,
+            }
+        engine = sqlalchemy.create_engine(database, **options)
+        if engine.name in ['sqlite', 'sqlite3']:
+            # Same query bindings pycsw registers on its own engines.
+            def connect(dbapi_connection, connection_record):
+                create_custom_sql_functions(dbapi_connection)
+            sqlalchemy.event.listen(engine, 'connect', connect)
+        Repository._engines[database] = engine
+
+    return Repository._engines[database]
+
+
+def repository_template(database, table):
+    """State shared by the repositories of database, built once per process.
+    """
+    key = (database, table)
+    with REPOSITORY_TEMPLATES_LOCK:
+        if key not in REPOSITORY_TEMPLATES:
+            database_engine(database)
+            template = Repository(database, CSW_CONTEXT, table=table)
+            template.session.close()
+            state = dict(template.__dict__)
+            del state['session']
+            REPOSITORY_TEMPLATES[key] = state
+
+    return REPOSITORY_TEMPLATES[key]
+
+
 class RegistryRepository(Repository):
     def __init__(self, *args, **kwargs):
+        self.catalog = None
         if args and hasattr(args[0], 'url'):
             url = args[0].url
             self.catalog = parse_catalog_from_url(url) if urlparse(url).path != '/csw' else None
 
+        # Bulk buffer, a list of (identifier, action and source lines).
+        self.es_buffer = []
+        self.es_buffer_bytes = 0
+
         try:
             self.es, self.version = es_connect(url=REGISTRY_SEARCH_URL)
             self.es_status = 200
@@ -381,25 +766,116 @@ class RegistryRepository(Repository):
             self.es_status = 404
 
         database = PYCSW['repository']['database']
+        table = kwargs.get('table', PYCSW['repository']['table'])
 
-        return super(RegistryRepository, self).__init__(database, context=config.StaticContext())
+        # Share the engine, reflected table and queryables, only the session is per repository.
+        self.__dict__.update(repository_template(database, table))
+        self.session = create_session(self.engine)
 
     def insert(self, *args, **kwargs):
         record = args[0]
         super(RegistryRepository, self).insert(*args)
+        self.invalidate(record)
         if self.es_status != 200:
             return
-        if not check_index_exists(self.catalog):
-            print('Cannot add layer {0}. Catalog {1} does not exist!'.format(record.identifier, self.catalog))
-            return
 
+        self.index(record)
+
+    def insert_batch(self, records, errors=None):
+        """Insert records in a single SQL transaction and queue them for indexing.
+           When the transaction fails the records are inserted one by one, so a bad
+           record only costs itself. Returns the number of records inserted.
+        """
+        try:
+            self.session.begin()
+            self.session.add_all(records)
+            self.session.commit()
+            inserted = records
+        except Exception:
+            self.session.rollback()
+            inserted = []
+            for record in records:
+                try:
+                    super(RegistryRepository, self).insert(record, 'local', record.insert_date)
+                    inserted.append(record)
+                except Exception as e:
+                    if errors is not None:
+                        errors.append('{0}: {1}'.format(record.identifier, e))
+
+        [self.invalidate(record) for record in inserted]
+        if self.es_status == 200:
+            [self.index(record) for record in inserted]
+
+        return len(inserted)
+
+    def invalidate(self, record):
+        """Drop anything derived from an earlier version of the record.
+        """
+        RECORDS.discard(record.identifier)
+        MISSING_RECORDS.discard(record.identifier)
+        if REGISTRY_TILE_CACHE_DIR:
+            purge_tile_cache(record.identifier)
+
+    def index(self, record):
+        """Add a record to the bulk buffer, sending it when the batch size or byte limit is reached.
+           Returns the number of records indexed by that batch, 0 while buffering.
+        """
         es_dict = record_to_dict(record)
         # TODO: Do not index wrong bounding boxes.
+        lines = '{0}\n{1}\n'.format(json.dumps({'index': {}}),
+                                    json.dumps(es_dict, default=encode_date_optional_time))
+        self.es_buffer.append((record.identifier, lines))
+        self.es_buffer_bytes += len(lines)
+        PENDING_REPOSITORIES.add(self)
+
+        if len(self.es_buffer) >= REGISTRY_INDEX_BATCH_SIZE or self.es_buffer_bytes >= REGISTRY_INDEX_BATCH_BYTES:
+            return self.flush()
+
+        return 0
+
+    def flush(self):
+        """Send buffered records to Elasticsearch in a single _bulk request.
+           Returns the number of records indexed.
+        """
+        buffered = self.es_buffer
+        self.es_buffer, self.es_buffer_bytes = [], 0
+        PENDING_REPOSITORIES.discard(self)
+        if not buffered:
+            return 0
+
+        if not check_index_exists(self.catalog):
+            for identifier, _ in buffered:
+                print('Cannot add layer {0}. Catalog {1} does not exist!'.format(identifier, self.catalog))
+            return 0
+
         try:
-            self.es[self.catalog]['layer'].post(data=es_dict)
-            print("Record {0} indexed".format(es_dict['title']))
-        except ElasticException as e:
+            response = self.es[self.catalog]['layer'].post('_bulk', data=''.join(lines for _, lines in buffered))
+        except (ElasticException, requests.exceptions.ConnectionError) as e:
+            if isinstance(e, requests.exceptions.ConnectionError):
+                es_disconnect(REGISTRY_SEARCH_URL)
             print(e)
+            return 0
+
+        indexed = 0
+        for (identifier, _), item in zip(buffered, response['items']):
+            result = item.get('index', item.get('create', {}))
+            if 'error' in result:
+                print('Record {0} not indexed: {1}'.format(identifier, result['error']))
+            else:
+                indexed += 1
+        print('{0} of {1} records indexed in catalog {2}'.format(indexed, len(buffered), self.catalog))
+        if indexed and SEARCH_CACHE:
+            SEARCH_CACHE.bump(self.catalog)
+
+        return indexed
+
+
+@atexit.register
+def flush_repositories():
+    """Index whatever is still buffered when the process exits.
+    """
+    for repository in list(PENDING_REPOSITORIES):
+        repository.flush()
 
 
 def parse_get_params(request):
@@ -625,6 +1101,11 @@ class SearchSerializer(serializers.Serializer):
         required=False,
         help_text="Constrains docs by matching exactly a certain user."
     )
+    q_catalogs = serializers.CharField(
+        required=False,
+        help_text="Comma separated catalogs to search in, all of them by default. Ignored when searching a "
+                  "single catalog. Example: catalog_a,catalog_b"
+    )
     d_docs_limit = serializers.IntegerField(
         required=False,
         help_text="How many documents to return.",
@@ -642,6 +1123,12 @@ class SearchSerializer(serializers.Serializer):
         default="score",
         choices=["score", "time", "distance"]
     )
+    d_docs_cursor = serializers.CharField(
+        required=False,
+        help_text="Pages through the documents from the d.docs.cursor of the previous response, '*' for the "
+                  "first page. Unlike d.docs.page, deep pages cost as much as the first one. Ignores d.docs.page. "
+                  "Requires Elasticsearch 5 or later."
+    )
     a_time_limit = serializers.IntegerField(
         required=False,
         help_text="Non-0 triggers time/date range faceting. This value is the maximum number of time ranges to "
@@ -672,8 +1159,9 @@ class SearchSerializer(serializers.Serializer):
     )
     a_hm_filter = serializers.CharField(
         required=False,
-        help_text="To explicitly specify the grid level, e.g. to let a user ask for greater or courser resolution "
-                  "than the most recent request. Ignores a.hm.limit."
+        help_text="To explicitly specify the region of the heatmap, defaults to q.geo. "
+                  "The coordinates are in lat,lon format. "
+                  "Example: [-90,-180 TO 90,180]"
     )
 
     a_text_limit = serializers.IntegerField(
@@ -692,6 +1180,16 @@ class SearchSerializer(serializers.Serializer):
         help_text="Returns te original search engine response.",
         default=0
     )
+    d_docs_fields = serializers.CharField(
+        required=False,
+        help_text="Comma separated fields of the documents to return, all of them by default. "
+                  "Example: title,layer_identifier,bbox"
+    )
+    request_echo = serializers.IntegerField(
+        required=False,
+        help_text="0 leaves request_url and request_body out of the response.",
+        default=1
+    )
 
     def validate_q_time(self, value):
         """
@@ -719,6 +1217,33 @@ class SearchSerializer(serializers.Serializer):
         except Exception as e:
             raise serializers.ValidationError(e)
 
+    def validate_a_hm_filter(self, value):
+        return self.validate_q_geo(value)
+
+    def validate_a_hm_gridlevel(self, value):
+        if not 1 <= value <= 12:
+            raise serializers.ValidationError("a_hm_gridlevel must be between 1 and 12")
+        return value
+
+    def validate_d_docs_cursor(self, value):
+        try:
+            decode_cursor(value)
+        except Exception:
+            raise serializers.ValidationError("d_docs_cursor is not a cursor returned by the search api")
+        return value
+
+    def validate_q_catalogs(self, value):
+        catalogs = [catalog.strip() for catalog in value.split(',') if catalog.strip()]
+        if not catalogs or not all(re.match(r'^\w+$', catalog) for catalog in catalogs):
+            raise serializers.ValidationError("q_catalogs must be a comma separated list of catalogs")
+        return catalogs
+
+    def validate_d_docs_fields(self, value):
+        fields = [field.strip() for field in value.split(',') if field.strip()]
+        if not fields:
+            raise serializers.ValidationError("d_docs_fields must name at least one field")
+        return fields
+
     def validate_d_docs_page(self, value):
         """
         paginations cant be zero or negative.
@@ -730,176 +1255,238 @@ class SearchSerializer(serializers.Serializer):
         return value
 
 
-def elasticsearch(serializer, catalog):
+# Relative cost of the filters, the cheapest ones run first.
+FILTER_COSTS = {'term': 0, 'range': 1, 'query_string': 2, 'geo_shape': 3}
+
+
+def search_query(validated_data, es_version, plan=None):
     """
-    https://www.elastic.co/guide/en/elasticsearch/reference/current/_the_search_api.html
-    :param serializer:
-    :return:
+    Query part of a search body, built from the q_* parameters.
+    Only q_text scores documents, the other parameters become cacheable filters
+    ordered by cost, and filters matching every document are left out.
+    Each decision is described in plan when a list is given.
     """
-
-    search_endpoint = serializer.validated_data.get("search_engine_endpoint")
-    search_engine_endpoint = "{0}/_search".format(search_endpoint)
-    if catalog:
-        search_engine_endpoint = "{0}/{1}/_search".format(search_endpoint, catalog)
-    q_text = serializer.validated_data.get("q_text")
-    q_time = serializer.validated_data.get("q_time")
-    q_geo = serializer.validated_data.get("q_geo")
-    q_user = serializer.validated_data.get("q_user")
-    q_uuid = serializer.validated_data.get("q_uuid")
-    d_docs_sort = serializer.validated_data.get("d_docs_sort")
-    d_docs_limit = int(serializer.validated_data.get("d_docs_limit"))
-    d_docs_page = int(serializer.validated_data.get("d_docs_page"))
-    a_time_gap = serializer.validated_data.get("a_time_gap")
-    a_time_limit = serializer.validated_data.get("a_time_limit")
-    original_response = serializer.validated_data.get("original_response")
+    if plan is None:
+        plan = []
+    q_text = validated_data.get("q_text")
+    q_time = validated_data.get("q_time")
+    q_geo = validated_data.get("q_geo")
+    q_user = validated_data.get("q_user")
+    q_uuid = validated_data.get("q_uuid")
 
     # Dict for search on Elastic engine
     must_array = []
-    filter_dic = {}
-    aggs_dic = {}
-
-    # get ES version to make the query builder to be backward compatible with
-    # diffs versions.
-    # TODO: move this to a proper place. maybe ES client?.
-    # TODO: cache it to avoid overwhelm ES with this call.
-    # TODO: ask for ES_VERSION when building queries with an elegant way.
-    ES_VERSION = 2
-    response = requests.get(REGISTRY_SEARCH_URL)
-    if response.ok:
-        # looks ugly but will work on normal ES response for "/".
-        ES_VERSION = int(response.json()["version"]["number"][0])
+    filters = []
 
     # String searching
     if q_text:
-        # Wrapping query string into a query filter.
-        query_string = {
-            "query_string": {
-                "query": q_text
-            }
-        }
-        if ES_VERSION < 2:
-            query_string = {
-                "query": {
-                    "query_string": {
-                        "query": q_text
-                    }
-                }
-            }
-
-        # add string searching
-        must_array.append(query_string)
+        must_array.append({"query_string": {"query": q_text}})
 
     if q_uuid:
-        # Wrapping query string into a query filter.
-        query_string = {
-            "query_string": {
-                "query": q_uuid
-            }
-        }
-        if ES_VERSION < 2:
-            query_string = {
-                "query": {
-                    "query_string": {
-                        "query": q_uuid
-                    }
-                }
-            }
-
-        # add string searching
-        must_array.append(query_string)
-
+        filters.append({"query_string": {"query": q_uuid}})
+        plan.append("q_uuid moved to filter context")
 
     if q_time:
-        # check if q_time exists
-        q_time = str(q_time)  # check string
-        shortener = q_time[1:-1]
-        shortener = shortener.split(" TO ")
-        gte = shortener[0]  # greater than
-        lte = shortener[1]  # less than
+        gte, lte = str(q_time)[1:-1].split(" TO ")
         layer_date = {}
-        if gte == '*' and lte != '*':
-            layer_date["lte"] = lte
-            range_time = {
-                "layer_date": layer_date
-            }
-            range_time = {"range": range_time}
-            must_array.append(range_time)
-        if gte != '*' and lte == '*':
-            layer_date["gte"] = gte
-            range_time = {
-                "layer_date": layer_date
-            }
-            range_time = {"range": range_time}
-            must_array.append(range_time)
-        if gte != '*' and lte != '*':
+        if gte != '*':
             layer_date["gte"] = gte
+        if lte != '*':
             layer_date["lte"] = lte
-            range_time = {
-                "layer_date": layer_date
-            }
-            range_time = {"range": range_time}
-            must_array.append(range_time)
+        if layer_date:
+            filters.append({"range": {"layer_date": layer_date}})
+            plan.append("q_time moved to filter context")
+        else:
+            plan.append("q_time dropped, [* TO *] matches every document")
+
     # geo_shape searching
     if q_geo:
-        q_geo = str(q_geo)
-        q_geo = q_geo[1:-1]
-        Ymin, Xmin = q_geo.split(" TO ")[0].split(",")
-        Ymax, Xmax = q_geo.split(" TO ")[1].split(",")
-        geoshape_query = {
-            "layer_geoshape": {
-                "shape": {
-                    "type": "envelope",
-                    "coordinates": [[Xmin, Ymax], [Xmax, Ymin]]
-                },
-                "relation": "intersects"
-            }
-        }
-        filter_dic["geo_shape"] = geoshape_query
+        Ymin, Xmin, Ymax, Xmax = parse_geo_box(q_geo).bounds
+        if Ymin <= -90 and Xmin <= -180 and Ymax >= 90 and Xmax >= 180:
+            plan.append("q_geo dropped, the whole world matches every document")
+        else:
+            filters.append({
+                "geo_shape": {
+                    "layer_geoshape": {
+                        "shape": {
+                            "type": "envelope",
+                            "coordinates": [[Xmin, Ymax], [Xmax, Ymin]]
+                        },
+                        "relation": "intersects"
+                    }
+                }
+            })
 
     if q_user:
-        # Using q_user
-        user_searching = {
-            "term": {
-                "layer_originator": q_user
-            }
-        }
-        must_array.append(user_searching)
+        filters.append({"term": {"layer_originator": q_user}})
+        plan.append("q_user moved to filter context")
 
-    dic_query = {
-        "query": {
-            "bool": {
-                "must": must_array,
-                "filter": filter_dic
-            }
-        }
-    }
+    filters.sort(key=lambda clause: FILTER_COSTS[list(clause)[0]])
+    if len(filters) > 1:
+        plan.append("filters ordered by cost: {0}".format(", ".join(list(clause)[0] for clause in filters)))
+
+    if not must_array and not filters:
+        plan.append("no constraints, match_all")
+        return {"query": {"match_all": {}}}
+
+    if es_version < 2:
+        # Queries have to be wrapped to be used as filters before 2.0.
+        filters = [{"query": clause} if "query_string" in clause else clause for clause in filters]
+        filtered = {}
+        if must_array:
+            filtered["query"] = {"bool": {"must": must_array}}
+        if filters:
+            filtered["filter"] = {"bool": {"must": filters}}
+        return {"query": {"filtered": filtered}}
+
+    bool_query = {}
+    if must_array:
+        bool_query["must"] = must_array
+    if filters:
+        bool_query["filter"] = filters
+
+    return {"query": {"bool": bool_query}}
+
+
+# Cached outdated_fields results, cleared when an index is created or deleted.
+MAPPING_CHECKS = LRUCache(1000, ttl=REGISTRY_SEARCH_VERSION_TTL)
+
+
+def search_fields(validated_data):
+    """
+    Fields whose es_mapping definition the features of a search rely on.
+    """
+    fields = set()
+    if validated_data.get("a_hm_limit") or validated_data.get("a_hm_gridlevel"):
+        fields.add("layer_centroid")
+    if validated_data.get("d_docs_sort") == "distance":
+        fields.add("layer_centroid")
+    if validated_data.get("d_docs_cursor"):
+        fields.add("layer_identifier")
+    if validated_data.get("a_user_limit"):
+        fields.add("layer_originator")
+    if validated_data.get("a_text_limit"):
+        fields.add("alltext")
+
+    return sorted(fields)
+
+
+def outdated_fields(indices, fields):
+    """
+    Maps each index to the fields it does not map as es_mapping does, as in catalogs
+    created before those fields were added. Indices that cannot be checked pass.
+    """
+    key = (indices or '_all', tuple(fields))
+    outdated = MAPPING_CHECKS.get(key)
+    if outdated is not None:
+        return outdated
+
+    try:
+        es, version = es_connect(url=REGISTRY_SEARCH_URL)
+        response = es[key[0]].get('_mapping/layer/field/{0}'.format(','.join(fields)))
+    except (requests.exceptions.ConnectionError, ElasticException):
+        return {}
+
+    expected = es_mapping(version)['mappings']['layer']['properties']
+    outdated = {}
+    for index, mappings in response.items():
+        # Indices without layers are not catalogs.
+        if 'layer' not in mappings.get('mappings', {}):
+            continue
+        mapped = mappings['mappings']['layer']
+        for field in fields:
+            actual = mapped.get(field, {}).get('mapping', {}).get(field, {})
+            if not mapping_matches(actual, expected[field]):
+                outdated.setdefault(index, []).append(field)
+    MAPPING_CHECKS.set(key, outdated)
+
+    return outdated
+
+
+def mapping_matches(actual, expected):
+    if mapping_type(actual) != mapping_type(expected):
+        return False
+
+    # Text fields need fielddata enabled from 5.0, strings have it by default before.
+    if actual.get('type') == 'text' and expected.get('fielddata'):
+        return bool(actual.get('fielddata'))
+
+    return True
 
-    if ES_VERSION < 2:
-        dic_query = {
-            "query": {
-                "filtered": {
-                    "filter": {
-                        "bool": {
-                            "must": must_array,
-                            "should": filter_dic
-                        }
-                    }
-                }
-            }
-        }
 
-    # Page
-    if d_docs_limit:
-        dic_query["size"] = d_docs_limit
+def mapping_type(field_def):
+    """
+    Type of a field mapping, with strings of Elasticsearch before 5.0 as text or keyword.
+    Elasticsearch leaves out the default 'analyzed' index option of strings.
+    """
+    field_type = field_def.get('type')
+    if field_type == 'string':
+        return 'keyword' if field_def.get('index') == 'not_analyzed' else 'text'
+
+    return field_type
+
+
+def build_search(validated_data, catalog, es_version):
+    """
+    Builds the search of validated SearchSerializer data: the url to post it to,
+    its indices and body, and the heatmap grid to fill from the response.
+    Invalid combinations of parameters return a (400, error) tuple instead.
+    """
+
+    search_endpoint = validated_data.get("search_engine_endpoint")
+    search_engine_endpoint = "{0}/_search".format(search_endpoint)
+    q_catalogs = None if catalog else validated_data.get("q_catalogs")
+    indices = catalog or (','.join(q_catalogs) if q_catalogs else None)
+    if indices:
+        # A comma separated list of indices is searched as a single request.
+        search_engine_endpoint = "{0}/{1}/_search".format(search_endpoint, indices)
+    q_time = validated_data.get("q_time")
+    d_docs_sort = validated_data.get("d_docs_sort")
+    d_docs_cursor = validated_data.get("d_docs_cursor")
+    d_docs_limit = int(validated_data.get("d_docs_limit"))
+    d_docs_page = int(validated_data.get("d_docs_page"))
+    a_time_gap = validated_data.get("a_time_gap")
+    a_time_limit = validated_data.get("a_time_limit")
+    a_hm_limit = validated_data.get("a_hm_limit")
+    a_hm_gridlevel = validated_data.get("a_hm_gridlevel")
+    a_hm_filter = validated_data.get("a_hm_filter")
+    a_text_limit = validated_data.get("a_text_limit")
+    a_user_limit = validated_data.get("a_user_limit")
+    d_docs_fields = validated_data.get("d_docs_fields")
+
+    if d_docs_cursor and es_version < 5:
+        # Without search_after a cursor would be an offset, as costly as d.docs.page.
+        msg = "d_docs_cursor requires Elasticsearch 5 or later, use d_docs_page"
+        return 400, {"error": {"msg": msg}}
+
+    fields = search_fields(validated_data)
+    outdated = outdated_fields(indices, fields) if fields else {}
+    if outdated:
+        catalogs = sorted(set(CATALOGS.catalog(index) for index in outdated))
+        msg = "Reindex {0} to use this search, the mapping of {1} is outdated".format(
+            ', '.join(catalogs), ', '.join(sorted(set(sum(outdated.values(), [])))))
+        return 400, {"error": {"msg": msg}}
+
+    aggs_dic = {}
+
+    plan = []
+    dic_query = search_query(validated_data, es_version, plan)
+    LOGGER.debug('Query plan: %s', '; '.join(plan))
+
+    # Page, a 0 size skips fetching documents when only facets are wanted.
+    dic_query["size"] = d_docs_limit
+    if d_docs_fields:
+        dic_query["_source"] = d_docs_fields
 
     if d_docs_page:
         dic_query["from"] = d_docs_limit * d_docs_page - d_docs_limit
 
-    if d_docs_sort == "score":
-        dic_query["sort"] = {"_score": {"order": "desc"}}
+    sort = search_sort(d_docs_sort, validated_data.get("q_geo"))
+    if sort:
+        dic_query["sort"] = sort
 
-    if d_docs_sort == "time":
-        dic_query["sort"] = {"layer_date": {"order": "desc"}}
+    if d_docs_cursor:
+        paginate_with_cursor(dic_query, d_docs_cursor)
 
     if a_time_limit:
         # TODO: Work in progress, a_time_limit is incomplete.
@@ -923,27 +1510,105 @@ def elasticsearch(serializer, catalog):
         }
         aggs_dic['articles_over_time'] = time_gap
 
+    heatmap = None
+    if a_hm_limit or a_hm_gridlevel:
+        rectangle = parse_geo_box(a_hm_filter or validated_data.get("q_geo") or "[-90,-180 TO 90,180]")
+        bounds = (rectangle.bounds[1], rectangle.bounds[0], rectangle.bounds[3], rectangle.bounds[2])
+        heatmap = heatmap_grid(bounds, a_hm_gridlevel or heatmap_precision(bounds, a_hm_limit))
+        cells = heatmap['columns'] * heatmap['rows']
+        if cells > REGISTRY_HEATMAP_MAX_CELLS:
+            msg = "The heatmap would have {0} cells, more than the {1} allowed".format(
+                cells, REGISTRY_HEATMAP_MAX_CELLS)
+            return 400, {"error": {"msg": msg}}
+        aggs_dic['heatmap'] = {
+            "filter": {
+                "geo_bounding_box": {
+                    "layer_centroid": {
+                        "top_left": {"lat": heatmap['maxY'], "lon": heatmap['minX']},
+                        "bottom_right": {"lat": heatmap['minY'], "lon": heatmap['maxX']}
+                    }
+                }
+            },
+            "aggs": {
+                "cells": {
+                    "geohash_grid": {
+                        "field": "layer_centroid",
+                        "precision": heatmap['gridLevel'],
+                        "size": cells
+                    }
+                }
+            }
+        }
+
+    aggs_dic.update(terms_aggregations(a_user_limit, a_text_limit, es_version))
+    if q_catalogs:
+        aggs_dic['catalogs'] = catalogs_aggregation(q_catalogs, es_version)
+
     # adding aggreations on body query
     if aggs_dic:
         dic_query['aggs'] = aggs_dic
+
+    return {
+        'url': search_engine_endpoint,
+        'endpoint': search_endpoint,
+        'indices': indices,
+        'body': dic_query,
+        'request_body': json.dumps(dic_query),
+        'heatmap': heatmap,
+        'plan': plan,
+    }
+
+
+def elasticsearch(serializer, catalog):
+    """
+    https://www.elastic.co/guide/en/elasticsearch/reference/current/_the_search_api.html
+    :param serializer:
+    :return:
+    """
+
+    # get ES version to make the query builder to be backward compatible with
+    # diffs versions.
+    ES_VERSION = es_major_version(REGISTRY_SEARCH_URL)
+
+    search = build_search(serializer.validated_data, catalog, ES_VERSION)
+    if isinstance(search, tuple):
+        return search
+
     try:
-        res = requests.post(search_engine_endpoint, data=json.dumps(dic_query))
+        res = ES_SESSION.post(search['url'], data=search['request_body'])
     except Exception as e:
+        if isinstance(e, requests.exceptions.ConnectionError):
+            es_disconnect(serializer.validated_data.get("search_engine_endpoint"))
         return 500, {"error": {"msg": str(e)}}
 
     es_response = res.json()
 
-    if original_response:
+    if serializer.validated_data.get("original_response"):
         return es_response
 
+    return format_search(serializer.validated_data, search, es_response)
+
+
+def format_search(validated_data, search, es_response):
+    """
+    Formats the Elasticsearch response of a search from build_search.
+    """
+    d_docs_limit = int(validated_data.get("d_docs_limit"))
+    d_docs_cursor = validated_data.get("d_docs_cursor")
+    a_time_gap = validated_data.get("a_time_gap")
+    heatmap = search['heatmap']
+
     data = {}
 
     if 'error' in es_response:
         data["error"] = es_response["error"]
         return 400, data
 
-    data["request_url"] = res.url
-    data["request_body"] = json.dumps(dic_query)
+    if validated_data.get("request_echo"):
+        data["request_url"] = search['url']
+        data["request_body"] = search['request_body']
+        if DEBUG:
+            data["query_plan"] = search['plan']
     data["a.matchDocs"] = es_response['hits']['total']
     docs = []
     # aggreations response: facets searching
@@ -973,36 +1638,553 @@ def elasticsearch(serializer, catalog):
                     gap_count.append(temp)
             a_gap['counts'] = gap_count
             data['a.time'] = a_gap
+        if 'catalogs' in aggs:
+            data['a.catalog'] = catalogs_counts(aggs['catalogs'])
+        if 'users' in aggs:
+            data['a.user'] = terms_counts(aggs['users'])
+        if 'text' in aggs:
+            data['a.text'] = terms_counts(aggs['text'].get('terms', aggs['text']))
+        if 'heatmap' in aggs:
+            heatmap['counts_ints2D'] = heatmap_counts(heatmap, aggs['heatmap']['cells']['buckets'])
+            data['a.hm'] = heatmap
 
     if not int(d_docs_limit) == 0:
-        for item in es_response['hits']['hits']:
-            # data
-            temp = item['_source']['abstract']
-            if temp:
-                item['_source']['abstract'] = temp.encode('ascii', 'ignore').decode('utf-8')
-            docs.append(item['_source'])
+        docs = docs_from_hits(es_response['hits']['hits'])
 
     data["d.docs"] = docs
+    if d_docs_cursor:
+        data["d.docs.cursor"] = next_cursor(search['body'], es_response['hits']['hits'])
 
     return data
 
 
-def search_view(request, catalog=None):
-    request.GET = parse_get_params(request)
-    serializer = SearchSerializer(data=request.GET)
-    try:
-        serializer.is_valid(raise_exception=True)
-        data = elasticsearch(serializer, catalog)
-        data = json.dumps(data)
-        status = 200
-    except serializers.ValidationError as error:
-        data = error
-        status = 400
+def search_sort(d_docs_sort, q_geo):
+    """
+    Sort of the documents, 'distance' is from the center of q_geo.
+    """
+    if d_docs_sort == "score":
+        return {"_score": {"order": "desc"}}
 
-    return HttpResponse(data, status=status, content_type='application/json')
+    if d_docs_sort == "time":
+        return {"layer_date": {"order": "desc"}}
+
+    if d_docs_sort == "distance" and q_geo:
+        # parse_geo_box keeps the lat,lon order, x is the latitude.
+        center = parse_geo_box(q_geo).centroid
+        return {
+            "_geo_distance": {
+                "layer_centroid": {
+                    "lat": center.x,
+                    "lon": center.y
+                },
+                "order": "asc",
+                "unit": "km"
+            }
+        }
 
+    return None
 
-def configure_mapproxy(extra_config, seed=False, ignore_warnings=True, renderd=False):
+
+def docs_from_hits(hits):
+    docs = []
+    for item in hits:
+        # data
+        temp = item['_source'].get('abstract')
+        if temp:
+            item['_source']['abstract'] = temp.encode('ascii', 'ignore').decode('utf-8')
+        docs.append(item['_source'])
+
+    return docs
+
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    if cursor == '*':
+        return {}
+
+    position = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+    if not isinstance(position, dict):
+        raise ValueError('Invalid cursor {0}'.format(cursor))
+
+    return position
+
+
+def paginate_with_cursor(dic_query, cursor):
+    """
+    Pages a query from a d.docs.cursor. The sort ends with layer_identifier so every
+    document has a stable position, the query resumes after the last document
+    with search_after.
+    """
+    position = decode_cursor(cursor)
+    dic_query["sort"] = [
+        dic_query.get("sort", {"_score": {"order": "desc"}}),
+        {"layer_identifier": {"order": "asc"}}
+    ]
+    dic_query.pop("from", None)
+    if "after" in position:
+        dic_query["search_after"] = position["after"]
+
+
+def next_cursor(dic_query, hits):
+    """
+    Cursor of the page following hits, None after the last page.
+    """
+    if not hits or len(hits) < dic_query.get("size", 0):
+        return None
+
+    return encode_cursor({"after": hits[-1]["sort"]})
+
+
+def terms_aggregations(a_user_limit, a_text_limit, es_version):
+    """
+    Aggregations of the a.user and a.text facets.
+    """
+    aggs_dic = {}
+    if a_user_limit:
+        aggs_dic['users'] = {
+            "terms": {
+                "field": "layer_originator",
+                "size": a_user_limit
+            }
+        }
+
+    if a_text_limit:
+        text_terms = {
+            "terms": {
+                "field": "alltext",
+                "size": a_text_limit
+            }
+        }
+        # Sample the best matching documents of each shard, alltext has a very high cardinality.
+        if es_version >= 2:
+            text_terms = {
+                "sampler": {
+                    "shard_size": REGISTRY_TEXT_FACET_SAMPLE_SIZE
+                },
+                "aggs": {
+                    "terms": text_terms
+                }
+            }
+        aggs_dic['text'] = text_terms
+
+    return aggs_dic
+
+
+def catalogs_aggregation(catalogs, es_version):
+    """
+    Aggregation counting the documents of each catalog. Before 5.0 the _index
+    field cannot be aggregated and every catalog gets an indices filter instead.
+    """
+    if es_version >= 5:
+        return {
+            "terms": {
+                "field": "_index",
+                "size": len(catalogs)
+            }
+        }
+
+    filters = {}
+    for catalog in catalogs:
+        if es_version < 2:
+            filters[catalog] = {"indices": {"indices": [catalog], "filter": {"match_all": {}},
+                                            "no_match_filter": "none"}}
+        else:
+            filters[catalog] = {"indices": {"indices": [catalog], "query": {"match_all": {}},
+                                            "no_match_query": "none"}}
+
+    return {"filters": {"filters": filters}}
+
+
+def catalogs_counts(aggregation):
+    buckets = aggregation['buckets']
+    if isinstance(buckets, dict):
+        # Named filters buckets
+        buckets = [dict(bucket, key=catalog) for catalog, bucket in buckets.items()]
+    else:
+        # _index terms buckets name the indices behind the catalog aliases.
+        buckets = [dict(bucket, key=CATALOGS.catalog(bucket['key'])) for bucket in buckets]
+
+    return terms_counts({'buckets': sorted(buckets, key=lambda bucket: -bucket['doc_count'])})
+
+
+def terms_counts(aggregation):
+    """
+    Formats the buckets of a terms aggregation like the counts of a.time.
+    """
+    counts = [{'value': item['key'], 'count': item['doc_count']} for item in aggregation['buckets']]
+
+    return {'counts': counts}
+
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash_cell(precision):
+    """
+    Width and height in degrees of the geohash cells of a precision.
+    """
+    bits = 5 * precision
+    return 360.0 / 2 ** ((bits + 1) // 2), 180.0 / 2 ** (bits // 2)
+
+
+def geohash_decode(geohash):
+    """
+    Returns the lower left corner (lon, lat) of a geohash cell.
+    """
+    lon, lat = [-180.0, 180.0], [-90.0, 90.0]
+    even = True
+    for char in geohash:
+        value = GEOHASH_BASE32.index(char)
+        for bit in (16, 8, 4, 2, 1):
+            interval = lon if even else lat
+            middle = (interval[0] + interval[1]) / 2
+            if value & bit:
+                interval[0] = middle
+            else:
+                interval[1] = middle
+            even = not even
+
+    return lon[0], lat[0]
+
+
+def heatmap_grid(bounds, precision):
+    """
+    Grid of the geohash cells of a precision covering (min_x, min_y, max_x, max_y),
+    in the format of the a.hm response.
+    """
+    min_x, min_y, max_x, max_y = bounds
+    width, height = geohash_cell(precision)
+    first_column = max(int(math.floor((min_x + 180) / width)), 0)
+    last_column = min(int(math.ceil((max_x + 180) / width)), int(round(360 / width)))
+    first_row = max(int(math.floor((min_y + 90) / height)), 0)
+    last_row = min(int(math.ceil((max_y + 90) / height)), int(round(180 / height)))
+    last_column, last_row = max(last_column, first_column + 1), max(last_row, first_row + 1)
+
+    return {
+        'gridLevel': precision,
+        'columns': last_column - first_column,
+        'rows': last_row - first_row,
+        'minX': first_column * width - 180,
+        'maxX': last_column * width - 180,
+        'minY': first_row * height - 90,
+        'maxY': last_row * height - 90,
+        'projection': 'EPSG:4326',
+    }
+
+
+def heatmap_precision(bounds, limit):
+    """
+    Finest geohash precision whose grid over bounds has at most limit cells.
+    """
+    for precision in range(1, 13):
+        grid = heatmap_grid(bounds, precision)
+        if grid['columns'] * grid['rows'] > limit:
+            return max(precision - 1, 1)
+
+    return 12
+
+
+def heatmap_counts(grid, buckets):
+    """
+    Places geohash_grid buckets in the rows of the grid, from north to south.
+    Rows without counts are null, as is the whole grid when it is empty.
+    """
+    width, height = geohash_cell(grid['gridLevel'])
+    counts = [[0] * grid['columns'] for _ in range(grid['rows'])]
+    for bucket in buckets:
+        x, y = geohash_decode(bucket['key'])
+        column = int(round((x - grid['minX']) / width))
+        row = grid['rows'] - 1 - int(round((y - grid['minY']) / height))
+        if 0 <= column < grid['columns'] and 0 <= row < grid['rows']:
+            counts[row][column] += bucket['doc_count']
+
+    counts = [row if any(row) else None for row in counts]
+
+    return counts if any(counts) else None
+
+
+class SQLiteCache(object):
+    """Cache stored in a SQLite file, shared by every process of the host.
+       Same interface as LRUCache plus named counters. When the values go over
+       `maxbytes` the oldest entries are evicted first.
+    """
+
+    def __init__(self, path, ttl, maxbytes):
+        self.path = path
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                               '(key TEXT PRIMARY KEY, value TEXT, expires REAL, size INTEGER)')
+            connection.execute('CREATE TABLE IF NOT EXISTS counters '
+                               '(name TEXT PRIMARY KEY, value INTEGER, updated REAL)')
+            self.local.connection = connection
+
+        return connection
+
+    def get(self, key, default=None):
+        row = self.connection().execute('SELECT value FROM entries WHERE key = ? AND expires > ?',
+                                        (key, time.time())).fetchone()
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+
+        return row[0]
+
+    def set(self, key, value):
+        connection = self.connection()
+        now = time.time()
+        connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                           (key, value, now + self.ttl, len(value)))
+        connection.execute('DELETE FROM entries WHERE expires <= ?', (now,))
+
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.maxbytes:
+            return
+        for evicted_key, size in connection.execute('SELECT key, size FROM entries ORDER BY expires').fetchall():
+            connection.execute('DELETE FROM entries WHERE key = ?', (evicted_key,))
+            with self.lock:
+                self.evictions += 1
+            total -= size
+            if total <= self.maxbytes:
+                break
+
+    def discard(self, key):
+        self.connection().execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def counter(self, name):
+        """Returns the value of a counter and the time it was last incremented.
+        """
+        row = self.connection().execute('SELECT value, updated FROM counters WHERE name = ?', (name,)).fetchone()
+        return tuple(row) if row else (0, 0)
+
+    def increment(self, name):
+        connection = self.connection()
+        connection.execute('INSERT OR IGNORE INTO counters VALUES (?, 0, 0)', (name,))
+        connection.execute('UPDATE counters SET value = value + 1, updated = ? WHERE name = ?', (time.time(), name))
+
+    def stats(self):
+        row = self.connection().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        with self.lock:
+            return {
+                'size': row[0],
+                'bytes': row[1],
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class SearchCache(object):
+    """Search responses keyed by the normalized query, the catalog and its generation.
+       Bumping the generation of a catalog makes every response cached for it, and
+       for searches across all catalogs, unreachable. Generations are shared between
+       processes by the sqlite store only, the memory store keeps them per process.
+    """
+
+    def __init__(self, url, ttl, maxbytes):
+        if url.startswith('sqlite:///'):
+            self.store = SQLiteCache(url[len('sqlite:///'):], ttl, maxbytes)
+        else:
+            self.store = LRUCache(REGISTRY_SEARCH_CACHE_SIZE, ttl, maxbytes)
+            self.generations = {}
+            self.lock = threading.Lock()
+
+    def generation(self, name):
+        if isinstance(self.store, SQLiteCache):
+            return self.store.counter(name)
+
+        return self.generations.get(name, (0, 0))
+
+    def bump(self, catalog):
+        for name in (catalog, '_all'):
+            if isinstance(self.store, SQLiteCache):
+                self.store.increment(name)
+                continue
+            with self.lock:
+                self.generations[name] = (self.generations.get(name, (0, 0))[0] + 1, time.time())
+
+    def key(self, validated_data, catalog):
+        """Cache key of a search. None while the catalog has changed too recently
+           for Elasticsearch to show the change, those responses are not cached.
+        """
+        generation, bumped = self.generation(catalog or '_all')
+        if time.time() - bumped < REGISTRY_SEARCH_CACHE_SETTLE:
+            return None
+
+        query = json.dumps([validated_data, catalog, generation], sort_keys=True, default=str)
+
+        return hashlib.md5(query.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value):
+        self.store.set(key, value)
+
+    def stats(self):
+        return self.store.stats()
+
+
+SEARCH_CACHE = None
+if REGISTRY_SEARCH_CACHE:
+    SEARCH_CACHE = SearchCache(REGISTRY_SEARCH_CACHE, REGISTRY_SEARCH_CACHE_TTL, REGISTRY_SEARCH_CACHE_MAX_BYTES)
+
+
+def search_view(request, catalog=None):
+    request.GET = parse_get_params(request)
+    serializer = SearchSerializer(data=request.GET)
+    try:
+        serializer.is_valid(raise_exception=True)
+        key = SEARCH_CACHE.key(serializer.validated_data, catalog) if SEARCH_CACHE else None
+        data = SEARCH_CACHE.get(key) if key else None
+        if data is None:
+            result = elasticsearch(serializer, catalog)
+            data = json.dumps(result)
+            # Errors come back as (status, body) tuples and are not cached.
+            if key and isinstance(result, dict) and 'error' not in result:
+                SEARCH_CACHE.set(key, data)
+        status = 200
+    except serializers.ValidationError as error:
+        data = error
+        status = 400
+
+    return HttpResponse(data, status=status, content_type='application/json')
+
+
+def msearch(endpoint, searches):
+    """
+    Sends searches from build_search to endpoint as a single _msearch request and
+    returns their responses in the same order.
+    """
+    lines = []
+    for search in searches:
+        lines.append(json.dumps({"index": search['indices'].split(',')} if search['indices'] else {}))
+        lines.append(search['request_body'])
+
+    res = ES_SESSION.post('{0}/_msearch'.format(endpoint), data='\n'.join(lines) + '\n',
+                          headers={'Content-Type': 'application/x-ndjson'})
+
+    return res.json()['responses']
+
+
+@csrf_exempt
+def batch_search_view(request):
+    """
+    Runs a JSON list of search parameters, as accepted by /api, in one _msearch.
+    The response lists what /api would return for each of them, in order.
+    Searches are sent with one _msearch per search_engine_endpoint.
+    """
+    if request.method != 'POST':
+        return HttpResponse('POST a JSON list of search parameters', status=405)
+
+    try:
+        params_list = json.loads(request.body.decode('utf-8'))
+    except ValueError as error:
+        return HttpResponse('Invalid JSON: {0}'.format(error), status=400)
+    if not isinstance(params_list, list) or len(params_list) > REGISTRY_SEARCH_BATCH_SIZE:
+        message = 'Expected a list of at most {0} search parameters'.format(REGISTRY_SEARCH_BATCH_SIZE)
+        return HttpResponse(message, status=400)
+
+    version = es_major_version(REGISTRY_SEARCH_URL)
+    results, searches = [], []
+    for params in params_list:
+        if not isinstance(params, dict):
+            results.append((400, {"error": {"msg": "Expected an object of search parameters"}}))
+            continue
+        # Same dotted names as the query string of /api, see parse_get_params.
+        params = dict((key.replace('.', '_'), value) for key, value in params.items())
+        serializer = SearchSerializer(data=params)
+        if not serializer.is_valid():
+            results.append((400, {"error": {"msg": serializer.errors}}))
+            continue
+        search = build_search(serializer.validated_data, None, version)
+        if not isinstance(search, tuple):
+            searches.append((len(results), serializer.validated_data, search))
+        results.append(search)
+
+    endpoints = collections.OrderedDict()
+    for item in searches:
+        endpoints.setdefault(item[2]['endpoint'], []).append(item)
+
+    for endpoint, group in endpoints.items():
+        try:
+            responses = msearch(endpoint, [search for _, _, search in group])
+        except Exception as e:
+            if isinstance(e, requests.exceptions.ConnectionError):
+                es_disconnect(endpoint)
+            for position, _, _ in group:
+                results[position] = (500, {"error": {"msg": str(e)}})
+            continue
+
+        for (position, validated_data, search), es_response in zip(group, responses):
+            if validated_data.get("original_response"):
+                results[position] = es_response
+            else:
+                results[position] = format_search(validated_data, search, es_response)
+
+    return HttpResponse(json.dumps(results), content_type='application/json')
+
+
+def export_view(request, catalog):
+    """
+    Streams every document of a catalog matching the q_* parameters as
+    newline delimited JSON, gzipped when the client accepts it.
+    """
+    request.GET = parse_get_params(request)
+    serializer = SearchSerializer(data=request.GET)
+    try:
+        serializer.is_valid(raise_exception=True)
+    except serializers.ValidationError as error:
+        return HttpResponse(error, status=400, content_type='application/json')
+
+    version = es_major_version(REGISTRY_SEARCH_URL)
+    body = search_query(serializer.validated_data, version)
+    if version >= 2:
+        # Index order is the cheapest to scroll through.
+        body['sort'] = ['_doc']
+
+    # Send the first request now, errors cannot be reported once the response has started.
+    hits = es_scroll(catalog, body)
+    try:
+        if not check_index_exists(catalog):
+            return HttpResponse('Catalog {0} does not exist'.format(catalog), status=404)
+        first = [next(hits)]
+    except StopIteration:
+        first = []
+    except ElasticException as e:
+        return HttpResponse(json.dumps({"error": {"msg": str(e)}}), status=400, content_type='application/json')
+    except requests.exceptions.ConnectionError as e:
+        es_disconnect(REGISTRY_SEARCH_URL)
+        return HttpResponse(json.dumps({"error": {"msg": str(e)}}), status=500, content_type='application/json')
+
+    lines = (json.dumps(hit['_source']) + '\n' for hit in itertools.chain(first, hits))
+    gzipped = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if gzipped:
+        lines = compress_sequence(lines)
+
+    response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+    if gzipped:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ('Accept-Encoding',))
+
+    return response
+
+
+def configure_mapproxy(extra_config, seed=False, ignore_warnings=True, renderd=False):
     """Create an validate mapproxy configuration based on a dict.
     """
     # Start with a sane configuration using MapProxy's defaults
@@ -1032,6 +2214,44 @@ def configure_mapproxy(extra_config, seed=False, ignore_warnings=True, renderd=F
 def get_mapproxy(layer, seed=False, ignore_warnings=True, renderd=False, config_as_yaml=True):
     """Creates a mapproxy config for a given layer-like object.
        Compatible with django-registry and GeoNode.
+       Apps are reused from MAPPROXY_APPS while the layer modification date is unchanged.
+    """
+    key = (getattr(layer, 'identifier', None), getattr(layer, 'date_modified', None))
+    cached = MAPPROXY_APPS.get(key) if key[0] else None
+    # Apps holding purged tiles are rebuilt.
+    if REGISTRY_TILE_CACHE_DIR and key[0] and refresh_tile_cache(key[0], key[1], force=cached is None):
+        cached = None
+    if cached is None:
+        cached = build_mapproxy(layer)
+        if key[0]:
+            MAPPROXY_APPS.set(key, cached)
+
+    app, extra_config, yaml_config = cached
+    if(config_as_yaml):
+        return app, yaml_config
+
+    return app, extra_config
+
+
+def build_mapproxy(layer, client_timeout=None):
+    """Returns a new MapProxy app for the layer, its config dict and the config as yaml.
+       client_timeout bounds every request the app sends to the upstream server.
+    """
+    extra_config = mapproxy_config(layer, client_timeout)
+    yaml_config = yaml.dump(extra_config, default_flow_style=False)
+    # If you want to test the resulting configuration. Turn on the next
+    # line and use that to generate a yaml config.
+    # assert False
+
+    conf = configure_mapproxy(extra_config)
+    # Create a MapProxy App
+    app = MapProxyApp(conf.configured_services(), conf.base_config)
+
+    return app, extra_config, yaml_config
+
+
+def mapproxy_config(layer, client_timeout=None):
+    """Returns the MapProxy config dict of the layer, without building an app.
     """
     bbox = list(wkt2geom(layer.wkt_geometry))
     bbox = ",".join([format(x, '.4f') for x in bbox])
@@ -1094,7 +2314,7 @@ def get_mapproxy(layer, seed=False, ignore_warnings=True, renderd=False, config_
         }
     }
 
-    # A cache that does not store for now. It needs a grid and a source.
+    # A cache that does not store unless REGISTRY_TILE_CACHE_DIR is set. It needs a grid and a source.
     caches = {
         'default_cache': {
             'disable_storage': True,
@@ -1102,6 +2322,9 @@ def get_mapproxy(layer, seed=False, ignore_warnings=True, renderd=False, config_
             'sources': ['default_source']
         },
     }
+    if REGISTRY_TILE_CACHE_DIR and getattr(layer, 'identifier', None):
+        del caches['default_cache']['disable_storage']
+        caches['default_cache']['cache'] = tile_cache_config(layer.identifier)
 
     # The layer is connected to the cache
     layers = [
@@ -1143,6 +2366,13 @@ def get_mapproxy(layer, seed=False, ignore_warnings=True, renderd=False, config_
             'ssl_no_cert_checks': True
         },
     }
+    if client_timeout:
+        global_config['http']['client_timeout'] = client_timeout
+    if REGISTRY_TILE_CACHE_DIR:
+        global_config['cache'] = {
+            'base_dir': REGISTRY_TILE_CACHE_DIR,
+            'lock_dir': os.path.join(REGISTRY_TILE_CACHE_DIR, 'locks'),
+        }
 
     # Populate a dictionary with custom config changes
     extra_config = {
@@ -1154,20 +2384,132 @@ def get_mapproxy(layer, seed=False, ignore_warnings=True, renderd=False, config_
         'globals': global_config,
     }
 
-    yaml_config = yaml.dump(extra_config, default_flow_style=False)
-    # If you want to test the resulting configuration. Turn on the next
-    # line and use that to generate a yaml config.
-    # assert False
+    return extra_config
 
-    conf = configure_mapproxy(extra_config)
-    # Create a MapProxy App
-    app = MapProxyApp(conf.configured_services(), conf.base_config)
 
-    # Wrap it in an object that allows to get requests by path as a string.
-    if(config_as_yaml):
-        return app, yaml_config
+MAPPROXY_APPS = LRUCache(REGISTRY_MAPPROXY_CACHE_SIZE)
+
+
+def tile_cache_directory(identifier):
+    return os.path.join(REGISTRY_TILE_CACHE_DIR, re.sub(r'[^\w.-]', '_', identifier))
+
+
+def tile_cache_config(identifier):
+    """MapProxy cache options storing the tiles of a layer in its own directory.
+    """
+    directory = tile_cache_directory(identifier)
+    if REGISTRY_TILE_CACHE_TYPE == 'mbtiles':
+        return {'type': 'mbtiles', 'filename': os.path.join(directory, 'tiles.mbtiles')}
+
+    return {'type': REGISTRY_TILE_CACHE_TYPE, 'directory': directory}
+
+
+# Layers whose tile directory was checked in the last minute, and the last prune run.
+TILE_CACHE_CHECKS = LRUCache(REGISTRY_MAPPROXY_CACHE_SIZE * 10, ttl=60)
+TILE_CACHE_STATE = {'pruned': 0}
+
+
+def ensure_directory(directory):
+    """Create the directory unless it exists, also when another process creates it meanwhile.
+    """
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
 
-    return app, extra_config
+
+def refresh_tile_cache(identifier, modified, force=False):
+    """Purge the tiles of a layer when its record changed or they are older than
+       REGISTRY_TILE_CACHE_EXPIRY, and record the access for LRU eviction.
+       Runs at most once a minute per layer unless forced. Returns True if tiles were purged.
+    """
+    now = time.time()
+    if not force and TILE_CACHE_CHECKS.get(identifier) is not None:
+        return False
+    TILE_CACHE_CHECKS.set(identifier, now)
+
+    directory = tile_cache_directory(identifier)
+    marker = os.path.join(directory, '.modified')
+    try:
+        with open(marker) as f:
+            current = f.read()
+        age = now - os.path.getmtime(marker)
+    except (IOError, OSError):
+        current, age = None, 0
+
+    purged = current is not None and (current != str(modified) or age > REGISTRY_TILE_CACHE_EXPIRY)
+    if purged:
+        purge_tile_cache(identifier)
+        TILE_CACHE_CHECKS.set(identifier, now)
+    if current is None or purged:
+        ensure_directory(directory)
+        with open(marker, 'w') as f:
+            f.write(str(modified))
+
+    with open(os.path.join(directory, '.accessed'), 'w'):
+        pass
+
+    if now - TILE_CACHE_STATE['pruned'] > REGISTRY_TILE_CACHE_PRUNE_INTERVAL:
+        TILE_CACHE_STATE['pruned'] = now
+        thread = threading.Thread(target=prune_tile_cache, name='registry-tiles')
+        thread.daemon = True
+        thread.start()
+
+    return purged
+
+
+def purge_tile_cache(identifier):
+    """Remove every cached tile of a layer.
+       The MapProxy apps of the layer are evicted first, sqlite and mbtiles caches
+       keep their database files open until the app is released.
+    """
+    directory = tile_cache_directory(identifier)
+    MAPPROXY_APPS.discard_if(lambda key: tile_cache_directory(key[0]) == directory)
+    TILE_CACHE_CHECKS.discard(identifier)
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def directory_size(directory):
+    size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+
+    return size
+
+
+def prune_tile_cache(max_bytes=None):
+    """Remove the least recently used layers until the tile cache fits in
+       max_bytes, REGISTRY_TILE_CACHE_MAX_BYTES by default. Returns the bytes removed.
+    """
+    if max_bytes is None:
+        max_bytes = REGISTRY_TILE_CACHE_MAX_BYTES
+
+    layers, total = [], 0
+    for name in os.listdir(REGISTRY_TILE_CACHE_DIR):
+        directory = os.path.join(REGISTRY_TILE_CACHE_DIR, name)
+        if name == 'locks' or not os.path.isdir(directory):
+            continue
+        try:
+            accessed = os.path.getmtime(os.path.join(directory, '.accessed'))
+        except OSError:
+            accessed = 0
+        size = directory_size(directory)
+        layers.append((accessed, size, name))
+        total += size
+
+    removed = 0
+    for accessed, size, name in sorted(layers):
+        if total - removed <= max_bytes:
+            break
+        purge_tile_cache(name)
+        removed += size
+
+    return removed
 
 
 def environ_from_url(path):
@@ -1214,15 +2556,39 @@ def get_path_info_params(yaml_text):
     return bbox_req, lay_name
 
 
+LAYER_UUID_PATTERN = r'[\w]{8}-[\w]{4}-[\w]{4}-[\w]{4}-[\w]{12}'
+RECORDS = LRUCache(REGISTRY_RECORD_CACHE_SIZE, ttl=REGISTRY_RECORD_CACHE_TTL)
+MISSING_RECORDS = LRUCache(REGISTRY_RECORD_CACHE_SIZE, ttl=REGISTRY_RECORD_CACHE_MISS_TTL)
+
+
 def layer_from_csw(layer_uuid):
-    # Get Layer with matching catalog and primary key
-    repository = RegistryRepository()
-    layer_ids = repository.query_ids([layer_uuid])
-    layer = None
-    if len(layer_ids) > 0:
-        layer = layer_ids[0]
+    return layers_from_csw([layer_uuid])[layer_uuid]
 
-    return layer
+
+def layers_from_csw(layer_uuids):
+    """Returns a dict of the layers by uuid, None for unknown uuids.
+       Layers missing from the record cache are loaded with a single query.
+    """
+    layers, query = {}, []
+    for layer_uuid in layer_uuids:
+        layers[layer_uuid] = RECORDS.get(layer_uuid)
+        if layers[layer_uuid] is None and not MISSING_RECORDS.get(layer_uuid):
+            query.append(layer_uuid)
+
+    if query:
+        # Get Layer with matching catalog and primary key
+        repository = RegistryRepository()
+        found = dict((layer.identifier, layer) for layer in repository.query_ids(query))
+        # Cached records are shared between requests, detach them from this session.
+        repository.session.expunge_all()
+        for layer_uuid in query:
+            layers[layer_uuid] = found.get(layer_uuid)
+            if layers[layer_uuid] is None:
+                MISSING_RECORDS.set(layer_uuid, True)
+            else:
+                RECORDS.set(layer_uuid, layers[layer_uuid])
+
+    return layers
 
 ## Return the layer as JSON
 #
@@ -1236,9 +2602,8 @@ def layer_json_view(request, layer_uuid):
     if not layer:
         return HttpResponse("Layer with uuid {0} not found.".format(layer_uuid), status=404)
 
-    # Set up a mapproxy app for this particular layer
-    _, config = get_mapproxy(layer, config_as_yaml=False)
-    json_contents = json.dumps(config)
+    # The configuration alone, MAPPROXY_APPS is kept for the layers serving tiles.
+    json_contents = json.dumps(mapproxy_config(layer))
 
     response = HttpResponse(json_contents, content_type='application/json')
 
@@ -1258,6 +2623,43 @@ def layer_yml_view(request, layer_uuid):
     return response
 
 
+@csrf_exempt
+def layer_batch_view(request):
+    """MapProxy configurations (format=js, the default) or CSW records (format=xml) of several layers.
+       ids is a comma separated list of uuids, in the query string or a POST form.
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    layer_uuids = []
+    for layer_uuid in params.get('ids', '').split(','):
+        layer_uuid = layer_uuid.strip()
+        if layer_uuid and layer_uuid not in layer_uuids:
+            layer_uuids.append(layer_uuid)
+
+    if not layer_uuids or len(layer_uuids) > REGISTRY_LAYER_BATCH_SIZE:
+        message = 'ids must list between 1 and {0} layer uuids'.format(REGISTRY_LAYER_BATCH_SIZE)
+        return HttpResponse(message, status=400)
+    invalid = [layer_uuid for layer_uuid in layer_uuids if not re.match(LAYER_UUID_PATTERN + '$', layer_uuid)]
+    if invalid:
+        return HttpResponse('Invalid layer uuids: {0}'.format(', '.join(invalid)), status=400)
+
+    if params.get('format', 'js') == 'xml':
+        # pycsw fetches every record of a GetRecordById with a single query.
+        query_string = ('service=CSW&version=3.0.0&request=GetRecordById&elementsetname=full&'
+                        'resulttype=results&id={0}'.format(','.join(layer_uuids)))
+        request.META['QUERY_STRING'] = query_string
+        request.META['REQUEST_METHOD'] = 'GET'
+        return csw_view(request)
+
+    layers = layers_from_csw(layer_uuids)
+    configs = collections.OrderedDict()
+    for layer_uuid in layer_uuids:
+        configs[layer_uuid] = None
+        if layers[layer_uuid] is not None:
+            configs[layer_uuid] = mapproxy_config(layers[layer_uuid])
+
+    return HttpResponse(json.dumps(configs), content_type='application/json')
+
+
 def layer_xml_view(request, layer_uuid):
     query_string = ('service=CSW&version=3.0.0&request=GetRecordById&elementsetname=full&'
                     'resulttype=results&id={0}'.format(layer_uuid))
@@ -1267,22 +2669,25 @@ def layer_xml_view(request, layer_uuid):
     return response
 
 
-def layer_png_view(request, layer_uuid):
-    layer = layer_from_csw(layer_uuid)
-    if not layer:
-        return HttpResponse("Layer with uuid {0} not found.".format(layer_uuid), status=404)
-
+def render_thumbnail(layer, exceptions='application/vnd.ogc.se_inimage', timeout=None):
+    """Render the layer thumbnail with a WMS GetMap through its MapProxy app.
+       With a timeout, the render uses its own app whose upstream requests are bounded by it.
+       Returns the WSGI status, the content type and the body.
+    """
     # Set up a mapproxy app for this particular layer
-    mp, yaml_config = get_mapproxy(layer)
-    yaml_text = yaml.load(yaml_config)
+    if timeout:
+        mp, config, _ = build_mapproxy(layer, client_timeout=timeout)
+    else:
+        mp, config = get_mapproxy(layer, config_as_yaml=False)
 
     captured = []
     output = []
-    bbox_req, lay_name = get_path_info_params(yaml_text)
+    bbox_req, lay_name = get_path_info_params(config)
 
     path_info = ('/service?LAYERS={0}&FORMAT=image%2Fpng&SRS=EPSG%3A4326'
-                 '&EXCEPTIONS=application%2Fvnd.ogc.se_inimage&TRANSPARENT=TRUE&SERVICE=WMS&VERSION=1.1.1&'
-                 'REQUEST=GetMap&STYLES=&BBOX={1}&WIDTH=200&HEIGHT=150').format(lay_name, bbox_req)
+                 '&EXCEPTIONS={2}&TRANSPARENT=TRUE&SERVICE=WMS&VERSION=1.1.1&'
+                 'REQUEST=GetMap&STYLES=&BBOX={1}&WIDTH=200&HEIGHT=150').format(
+                     lay_name, bbox_req, url_quote(exceptions, safe=''))
 
     def start_response(status, headers, exc_info=None):
         captured[:] = [status, headers, exc_info]
@@ -1291,8 +2696,134 @@ def layer_png_view(request, layer_uuid):
     # Get a response from MapProxyAppy as if it was running standalone.
     environ = environ_from_url(path_info)
     app_iter = mp(environ, start_response)
+    try:
+        content = b''.join(output + list(app_iter))
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+    content_type = dict((k.lower(), v) for k, v in captured[1]).get('content-type', '')
+
+    return captured[0], content_type, content
+
+
+def thumbnail_etag(layer):
+    key = '{0}:{1}'.format(layer.identifier, layer.date_modified)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def thumbnail_path(layer):
+    """Thumbnails are stored as <identifier>/<etag>.png, one directory per layer.
+    """
+    identifier = re.sub(r'[^\w.-]', '_', layer.identifier)
+    return os.path.join(REGISTRY_THUMBNAIL_DIR, identifier, '{0}.png'.format(thumbnail_etag(layer)))
+
+
+def get_thumbnail(layer, errors=None):
+    """Return the stored thumbnail of the layer, rendering and storing it on a miss.
+       Returns None when the upstream server did not return an image, the reason
+       is added to the errors list when given.
+    """
+    path = thumbnail_path(layer)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except IOError:
+        pass
+
+    status, content_type, content = render_thumbnail(layer, exceptions='application/vnd.ogc.se_xml')
+    if not status.startswith('200') or not content_type.startswith('image/'):
+        if errors is not None:
+            errors.append(thumbnail_error(status, content))
+        return None
+
+    store_thumbnail(layer, content)
+
+    return content
+
+
+def thumbnail_error(status, content):
+    """Text of the WMS service exception returned instead of the thumbnail.
+    """
+    try:
+        messages = etree.fromstring(content).xpath('//*[local-name()="ServiceException"]/text()')
+    except (etree.XMLSyntaxError, ValueError):
+        messages = []
+
+    return ' '.join(message.strip() for message in messages) or status
+
+
+def thumbnail_error_image(message):
+    """Draw the error message into a thumbnail sized image, like MapProxy in-image exceptions.
+    """
+    image_opts = ImageOptions(format='image/png', transparent=True)
+    return message_image(message, size=(200, 150), image_opts=image_opts).as_buffer().read()
+
+
+def store_thumbnail(layer, content):
+    """Write the thumbnail atomically and drop thumbnails of older versions of the record.
+    """
+    path = thumbnail_path(layer)
+    directory = os.path.dirname(path)
+    ensure_directory(directory)
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.rename(temp_path, path)
+
+    for name in os.listdir(directory):
+        if name.endswith('.png') and name != os.path.basename(path):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def layer_last_modified(layer):
+    """Record modification date as seconds since the epoch, None if it cannot be parsed.
+    """
+    try:
+        modified = parse(layer.date_modified)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if modified.tzinfo is None:
+        modified = modified.replace(tzinfo=tz.tzutc())
+
+    return calendar.timegm(modified.utctimetuple())
+
+
+def not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return etag in if_none_match or if_none_match.strip() == '*'
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return bool(if_modified_since and last_modified and last_modified <= if_modified_since)
+
+
+def layer_png_view(request, layer_uuid):
+    layer = layer_from_csw(layer_uuid)
+    if not layer:
+        return HttpResponse("Layer with uuid {0} not found.".format(layer_uuid), status=404)
 
-    response = HttpResponse(next(app_iter), content_type='image/png')
+    etag = '"{0}"'.format(thumbnail_etag(layer))
+    last_modified = layer_last_modified(layer)
+
+    if not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+    else:
+        errors = []
+        content = get_thumbnail(layer, errors)
+        if content is None:
+            # Not stored, draw the error into the image instead of asking upstream again.
+            return HttpResponse(thumbnail_error_image(errors[0]), content_type='image/png')
+        response = HttpResponse(content, content_type='image/png')
+
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'public, max-age={0}'.format(REGISTRY_THUMBNAIL_MAX_AGE)
 
     return response
 
@@ -1319,17 +2850,43 @@ def layer_mapproxy(request, layer_uuid, path_info):
 
     # Get a response from MapProxyAppy as if it was running standalone.
     environ = environ_from_url(path_info)
+    # Let MapProxy answer conditional requests for tiles it has cached.
+    for header in ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE'):
+        if header in request.META:
+            environ[header] = request.META[header]
     app_iter = mp(environ, start_response)
 
     status = int(captured[0].split(' ')[0])
-    # Create a Django response from the MapProxy WSGI response (app_iter).
-    response = HttpResponse(app_iter, status=status)
-    # TODO: Append headers to response, in particular content_type is very important
-    # as some of the responses are images.
+    # Stream the MapProxy WSGI response (app_iter) instead of buffering it.
+    content = app_iter if not output else iterate_wsgi(output, app_iter)
+    response = StreamingHttpResponse(content, status=status)
+    for header, value in captured[1]:
+        if header.lower() not in HOP_BY_HOP_HEADERS:
+            response[header] = value
 
     return response
 
 
+# Headers owned by the server, a WSGI application may not set them.
+HOP_BY_HOP_HEADERS = set([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade',
+])
+
+
+def iterate_wsgi(output, app_iter):
+    """Yield data sent through the WSGI write callable before the app_iter chunks.
+    """
+    try:
+        for chunk in output:
+            yield chunk
+        for chunk in app_iter:
+            yield chunk
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
 def create_response_dict(catalog_id, catalog):
     dictionary = {
         'id': catalog_id,
@@ -1343,9 +2900,7 @@ def create_response_dict(catalog_id, catalog):
 
 
 def list_catalogs_view(request):
-    es, _ = es_connect(url=REGISTRY_SEARCH_URL)
-
-    list_catalogs = es.get('_aliases').keys()
+    list_catalogs = CATALOGS.names()
     response_list = [create_response_dict(i, catalog) for i, catalog in enumerate(list_catalogs)]
     message, status = json.dumps(response_list), 200
 
@@ -1357,6 +2912,17 @@ def list_catalogs_view(request):
     return response
 
 
+def stats_view(request):
+    stats = {
+        'mapproxy_apps': MAPPROXY_APPS.stats(),
+        'search_responses': SEARCH_CACHE.stats() if SEARCH_CACHE else None,
+        'records': RECORDS.stats(),
+        'missing_records': MISSING_RECORDS.stats(),
+    }
+
+    return HttpResponse(json.dumps(stats), status=200, content_type='application/json')
+
+
 def readme_view(request):
     with open('documentation.md') as f:
         readme = f.readlines()
@@ -1375,15 +2941,286 @@ def load_records(repo, parsed_xml, context):
     parsed_records = [metadata.parse_record(context, f, repo)[0] for f in parsed_records]
 
     [repo.insert(r, 'local', r.insert_date) for r in parsed_records]
+    repo.flush()
+
+
+def load_records_stream(repo, xml_file, context, errors=None):
+    """Load the records of a CSW Insert document one element at a time.
+       Finished elements are cleared so memory does not grow with the size of the file.
+       Records that cannot be parsed or inserted are reported in the errors list when given.
+       Returns the number of records inserted.
+    """
+    errors = [] if errors is None else errors
+    insert_tags = ['{%s}Insert' % context.namespaces[prefix] for prefix in ('csw', 'csw30')]
+    inserted, batch, insert_element = 0, [], None
+
+    for event, element in etree.iterparse(xml_file, events=('start', 'end'),
+                                          resolve_entities=False, huge_tree=True):
+        if element.tag in insert_tags:
+            insert_element = element if event == 'start' else None
+            continue
+        if event != 'end' or insert_element is None or element.getparent() is not insert_element:
+            continue
+
+        try:
+            batch.append(metadata.parse_record(context, element, repo)[0])
+        except Exception as e:
+            errors.append('{0}: {1}'.format(xml_file, e))
+
+        # Drop the record and everything parsed before it.
+        element.clear()
+        while element.getprevious() is not None:
+            del insert_element[0]
+
+        if len(batch) >= REGISTRY_INDEX_BATCH_SIZE:
+            inserted += repo.insert_batch(batch, errors)
+            batch = []
+
+    if batch:
+        inserted += repo.insert_batch(batch, errors)
+    repo.flush()
+
+    return inserted
+
+
+# Parser state for load_records_parallel worker processes.
+WORKER_STATE = {}
+
+
+def init_parse_worker(database, table):
+    # Connections of an engine inherited from the parent process must not be used here.
+    Repository._engines.pop(database, None)
+    context = config.StaticContext()
+    WORKER_STATE['context'] = context
+    WORKER_STATE['repository'] = Repository(database, context, table=table)
+
+
+def parse_records_file(xml_file):
+    """Parse the records of a CSW Insert file into plain column dicts.
+       Runs in a worker process, the ORM objects cannot be pickled back.
+    """
+    context, repo = WORKER_STATE['context'], WORKER_STATE['repository']
+    columns = [column.name for column in repo.dataset.__table__.columns]
+    records, errors = [], []
+
+    try:
+        parsed_xml = etree.parse(xml_file, context.parser)
+        xml_records = parsed_xml.xpath('//csw:Insert', namespaces=context.namespaces)[0]
+    except Exception as e:
+        return records, ['{0}: {1}'.format(xml_file, e)]
+
+    for xml_record in xml_records.xpath('child::*'):
+        try:
+            record = metadata.parse_record(context, xml_record, repo)[0]
+            records.append(dict((column, getattr(record, column)) for column in columns))
+        except Exception as e:
+            errors.append('{0}: {1}'.format(xml_file, e))
+
+    return records, errors
+
+
+def load_records_parallel(catalog, files_names, processes):
+    """Parse files in a pool of processes and insert the records from this one in batches.
+       Returns a summary dict with counters and the list of errors.
+    """
+    database, table = PYCSW['repository']['database'], PYCSW['repository']['table']
+    # Fork the workers before this process opens any database connection.
+    pool = multiprocessing.Pool(processes, init_parse_worker, (database, table))
+    repo = RegistryRepository(database, config.StaticContext(), table=table)
+    repo.catalog = catalog
+    summary = {'files': 0, 'records': 0, 'errors': []}
+    start = time.time()
+    batch = []
+
+    try:
+        for records, errors in pool.imap_unordered(parse_records_file, files_names):
+            summary['files'] += 1
+            summary['errors'].extend(errors)
+            batch.extend(repo.dataset(**values) for values in records)
+            if len(batch) >= REGISTRY_INDEX_BATCH_SIZE:
+                summary['records'] += repo.insert_batch(batch, summary['errors'])
+                batch = []
+        if batch:
+            summary['records'] += repo.insert_batch(batch, summary['errors'])
+    finally:
+        pool.close()
+        pool.join()
+        repo.flush()
+
+    summary['seconds'] = time.time() - start
+
+    return summary
+
+
+def reindex(catalog, all_records=False, chunk_size=REGISTRY_INDEX_BATCH_SIZE):
+    """Rebuild the index of a catalog from the records table, for example after a mapping change.
+       The records of the current index are loaded into a new <catalog>_<timestamp> index, which
+       then replaces it behind an alias named after the catalog, so searches keep working during
+       the load. The records table does not tell catalogs apart: all_records loads every record,
+       it is required when the catalog has no index yet. The new index is dropped, and the
+       catalog left unchanged, when a record could not be indexed.
+       Returns a summary dict with the counters.
+    """
+    es, version = es_connect(url=REGISTRY_SEARCH_URL)
+    old_indices = sorted(index for index, value in es.get('_aliases').items()
+                         if index == catalog or catalog in value.get('aliases', {}))
+    if not old_indices and not all_records:
+        raise ValueError('Catalog {0} has no index to take its records from'.format(catalog))
+
+    repo = RegistryRepository()
+    repo.catalog = '{0}_{1}'.format(catalog, time.strftime('%Y%m%d%H%M%S'))
+    create_index(repo.catalog, es, version)
+    summary = {'records': 0, 'indexed': 0, 'index': repo.catalog, 'replaced': False}
+    start = time.time()
+
+    # Refreshing while bulk loading only slows the load down.
+    es[repo.catalog].put('_settings', data={'index': {'refresh_interval': '-1'}})
+    try:
+        if all_records:
+            query = repo.session.query(repo.dataset).execution_options(stream_results=True)
+            records = query.yield_per(chunk_size)
+        else:
+            records = catalog_records(repo, catalog, chunk_size)
+        for record in records:
+            summary['records'] += 1
+            summary['indexed'] += repo.index(record)
+        summary['indexed'] += repo.flush()
+    except BaseException:
+        # Interrupted, the catalog keeps its current index.
+        delete_index(repo.catalog, es)
+        raise
+    summary['seconds'] = time.time() - start
+    if summary['indexed'] < summary['records']:
+        delete_index(repo.catalog, es)
+        return summary
+
+    es[repo.catalog].put('_settings', data={'index': {'refresh_interval': '1s'}})
+    es[repo.catalog].post('_refresh')
+
+    actions = [{'add': {'index': repo.catalog, 'alias': catalog}}]
+    actions.extend({'remove': {'index': index, 'alias': catalog}} for index in old_indices if index != catalog)
+    if catalog in old_indices:
+        # Created before reindex used aliases, an alias cannot take the name of an existing index.
+        delete_index(catalog, es)
+    es.post('_aliases', data={'actions': actions})
+    [delete_index(index, es) for index in old_indices if index != catalog]
+    CATALOGS.sync(es)
+    MAPPING_CHECKS.discard_if(lambda key: True)
+    if SEARCH_CACHE:
+        SEARCH_CACHE.bump(catalog)
+    summary['replaced'] = True
+
+    return summary
+
+
+def catalog_records(repo, catalog, chunk_size=500):
+    """Yield the records of the repository indexed in catalog, fetched chunk_size at a time.
+    """
+    body = {'_source': ['layer_identifier'], 'query': {'match_all': {}}}
+    identifiers = (hit['_source']['layer_identifier'] for hit in es_scroll(catalog, body, size=chunk_size))
+    chunk = list(itertools.islice(identifiers, chunk_size))
+    while chunk:
+        for record in repo.query_ids(chunk):
+            yield record
+        chunk = list(itertools.islice(identifiers, chunk_size))
+
+
+def thumbnail_layers(repo, catalog=None, since=None, chunk_size=500):
+    """Yield the records of the repository, or only those indexed in catalog,
+       modified on or after the since date when given.
+    """
+    if catalog:
+        for layer in catalog_records(repo, catalog, chunk_size):
+            if not since or (layer.date_modified or '') >= since:
+                yield layer
+        return
+
+    query = repo.session.query(repo.dataset).order_by(repo.dataset.identifier)
+    if since:
+        query = query.filter(repo.dataset.date_modified >= since)
+    for layer in query.yield_per(chunk_size):
+        yield layer
+
+
+def render_layer_thumbnail(layer, timeout, started, abandoned):
+    """Store the thumbnail of a layer unless it is already stored.
+       The render start time is kept in started, and the result is not stored when the
+       layer was abandoned in the meantime. Returns 'skipped', 'rendered', 'failed' or 'timeout'.
+    """
+    if os.path.exists(thumbnail_path(layer)):
+        return 'skipped'
+    started[layer.identifier] = time.time()
+    try:
+        status, content_type, content = render_thumbnail(layer, 'application/vnd.ogc.se_xml', timeout)
+    except Exception as e:
+        LOGGER.warn('Thumbnail for %s failed: %s', layer.identifier, e)
+        return 'failed'
+    if not status.startswith('200') or not content_type.startswith('image/'):
+        LOGGER.warn('Thumbnail for %s failed: %s', layer.identifier, thumbnail_error(status, content))
+        return 'failed'
+    if layer.identifier in abandoned:
+        return 'timeout'
+
+    store_thumbnail(layer, content)
+
+    return 'rendered'
+
+
+def render_thumbnails(catalog=None, since=None, threads=4, timeout=REGISTRY_THUMBNAIL_TIMEOUT):
+    """Pre-render the thumbnails of the repository records in a pool of threads.
+       Every upstream request of a render is bounded by timeout. As MapProxy may send more than
+       one request per render, a render is only abandoned after twice the timeout.
+       Layers already in the thumbnail store are skipped, so an interrupted run can be resumed.
+       Returns a summary dict with the counters.
+    """
+    repo = RegistryRepository()
+    pool = ThreadPool(threads)
+    summary = {'rendered': 0, 'skipped': 0, 'failed': 0, 'timeout': 0}
+    start = time.time()
+    layers = thumbnail_layers(repo, catalog, since)
+    started, abandoned = {}, set()
+
+    try:
+        # Submit a few layers per thread at a time to keep memory bounded.
+        chunk = list(itertools.islice(layers, threads * 4))
+        while chunk:
+            results = [(layer.identifier, pool.apply_async(render_layer_thumbnail,
+                                                           (layer, timeout, started, abandoned)))
+                       for layer in chunk]
+            for identifier, result in results:
+                # Queued layers are waited for, the backstop only counts from the render start.
+                while not result.ready() and time.time() - started.get(identifier, time.time()) < timeout * 2:
+                    result.wait(1)
+                if result.ready():
+                    summary[result.get()] += 1
+                else:
+                    abandoned.add(identifier)
+                    print('Thumbnail for {0} timed out'.format(identifier))
+                    summary['timeout'] += 1
+            done = sum(summary.values())
+            print('{0} layers processed, {1} rendered, {2} failed, {3} timed out ({4:.1f} layers/s)'.format(
+                done, summary['rendered'], summary['failed'], summary['timeout'],
+                done / max(time.time() - start, 0.001)))
+            chunk = list(itertools.islice(layers, threads * 4))
+    finally:
+        pool.terminate()
+
+    summary['seconds'] = time.time() - start
+
+    return summary
 
 
 urlpatterns = [
     url(r'^$', readme_view),
     url(r'^csw$', csw_view),
     url(r'^api$', search_view),
+    url(r'^api/batch$', batch_search_view),
     url(r'^catalog$', list_catalogs_view),
+    url(r'^stats$', stats_view),
     url(r'^catalog/(?P<catalog>\w+)/csw$', csw_view),
     url(r'^catalog/(?P<catalog>\w+)/api/$', search_view),
+    url(r'^catalog/(?P<catalog>\w+)/api/export.ndjson$', export_view),
+    url(r'^layer/batch$', layer_batch_view),
     url(r'^layer/(?P<layer_uuid>[\w]{8}-[\w]{4}-[\w]{4}-[\w]{4}-[\w]{12}).js$', layer_json_view, name="layer_json"),
     url(r'^layer/(?P<layer_uuid>[\w]{8}-[\w]{4}-[\w]{4}-[\w]{4}-[\w]{12}).yml$', layer_yml_view, name="layer_yml"),
     url(r'^layer/(?P<layer_uuid>[\w]{8}-[\w]{4}-[\w]{4}-[\w]{4}-[\w]{12}).png$', layer_png_view, name="layer_png"),
@@ -1398,22 +3235,31 @@ if __name__ == '__main__':  # pragma: no cover
 
     if 'pycsw' in sys.argv[:2]:
 
-        OPTS, ARGS = getopt.getopt(sys.argv[2:], 'c:f:ho:p:ru:x:s:t:y')
+        OPTS, ARGS = getopt.getopt(sys.argv[2:], 'c:f:hj:m:o:p:ru:x:s:t:y', ['all'])
 
-        xml_dirpath, catalog_slug = None, None
+        xml_dirpath, catalog_slug, processes, since, timeout = None, None, None, None, REGISTRY_THUMBNAIL_TIMEOUT
+        all_records = False
         for o, a in OPTS:
-            if o == '-c':
+            if o == '--all':
+                all_records = True
+            elif o == '-c':
                 COMMAND = a
             elif o == '-p':
                 xml_dirpath = a
             elif o == '-s':
                 catalog_slug = a
+            elif o == '-j':
+                processes = int(a)
+            elif o == '-m':
+                since = a
+            elif o == '-t':
+                timeout = int(a)
 
         database = PYCSW['repository']['database']
         table = PYCSW['repository']['table']
         home = PYCSW['server']['home']
 
-        available_commands = ['setup_db', 'get_sysprof', 'load_records']
+        available_commands = ['setup_db', 'get_sysprof', 'load_records', 'render_thumbnails', 'reindex']
 
         if COMMAND not in available_commands:
             print('pycsw supports only the following commands: %s' % available_commands)
@@ -1425,6 +3271,28 @@ if __name__ == '__main__':  # pragma: no cover
         elif COMMAND == 'get_sysprof':
             print(pycsw_admin.get_sysprof())
 
+        elif COMMAND == 'render_thumbnails':
+            summary = render_thumbnails(catalog_slug, since, processes or 4, timeout)
+            print('{0} rendered, {1} already stored, {2} failed, {3} timed out in {4:.1f}s'.format(
+                summary['rendered'], summary['skipped'], summary['failed'], summary['timeout'], summary['seconds']))
+            sys.exit(1 if summary['failed'] or summary['timeout'] else 0)
+
+        elif COMMAND == 'reindex':
+            if not catalog_slug:
+                print('Undefined catalog slug in command line input')
+                sys.exit(1)
+            try:
+                summary = reindex(catalog_slug, all_records)
+            except ValueError as e:
+                print('{0}, use --all to load every record of the database into it'.format(e))
+                sys.exit(1)
+            print('{0} of {1} records reindexed in {2} in {3:.1f}s ({4:.1f} records/s)'.format(
+                summary['indexed'], summary['records'], summary['index'], summary['seconds'],
+                summary['records'] / max(summary['seconds'], 0.001)))
+            if not summary['replaced']:
+                print('Catalog {0} left unchanged'.format(catalog_slug))
+                sys.exit(1)
+
         elif COMMAND == 'load_records':
             if os.path.isfile(xml_dirpath):
                 files_names = [xml_dirpath]
@@ -1437,6 +3305,18 @@ if __name__ == '__main__':  # pragma: no cover
                 print('Undefined catalog slug in command line input')
                 sys.exit(1)
 
+            # Create index with mapping in Elasticsarch.
+            create_index(catalog_slug)
+
+            if processes and processes > 1:
+                summary = load_records_parallel(catalog_slug, files_names, processes)
+                for error in summary['errors']:
+                    print(error)
+                print('{0} records from {1} files loaded in {2:.1f}s ({3:.1f} records/s), {4} errors'.format(
+                    summary['records'], summary['files'], summary['seconds'],
+                    summary['records'] / max(summary['seconds'], 0.001), len(summary['errors'])))
+                sys.exit(1 if summary['errors'] else 0)
+
             # Create repository object with catalog slug.
             context = config.StaticContext()
             repo = RegistryRepository(PYCSW['repository']['database'],
@@ -1444,13 +3324,13 @@ if __name__ == '__main__':  # pragma: no cover
                                       table=PYCSW['repository']['table'])
             repo.catalog = catalog_slug
 
-            # Create index with mapping in Elasticsarch.
-            create_index(catalog_slug)
-
-            # Parse each xml file and insert records.
+            # Stream each xml file and insert records.
+            errors = []
             for xml_file in files_names:
-                parsed_xml = etree.parse(xml_file, context.parser)
-                load_records(repo, parsed_xml, context)
+                load_records_stream(repo, xml_file, context, errors)
+            for error in errors:
+                print(error)
+            sys.exit(1 if errors else 0)
 
         sys.exit(0)
 
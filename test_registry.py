@@ -1,9 +1,13 @@
+import gzip
+import io
 import json
+import os
 import pytest
 import random
 import rawes
 import registry
 import requests
+import time
 from datetime import datetime
 from django.test import RequestFactory
 from pycsw.core import config
@@ -211,6 +215,20 @@ def test_create_catalog(client):
     assert response.get('Content-Type') == 'application/json'
 
 
+def test_csw_config(client):
+    response = client.get('/catalog/{0}/csw'.format(catalog_slug),
+                          {'service': 'CSW', 'request': 'GetCapabilities', 'version': '2.0.2'})
+    assert 200 == response.status_code
+    assert b'Transaction' in response.content
+
+    # Catalog requests do not leak transactions or their url into other requests.
+    assert 'false' == registry.PYCSW['manager']['transactions']
+    assert 'url' not in registry.PYCSW['server']
+    config = registry.csw_config('http://localhost/csw')
+    assert 'false' == config['manager']['transactions']
+    assert 'http://localhost/csw' == config['server']['url']
+
+
 def test_create_transaction(client):
     # Create payload and insert data into both pycsw database and elasticsearch.
     payload = construct_payload(layers_list=layers_list)
@@ -398,6 +416,161 @@ def test_q_geo(client):
     assert 400 == response.status_code
 
 
+def test_d_docs_sort_distance(client):
+    params = default_params.copy()
+    params["d_docs_limit"] = 100
+    params["d_docs_sort"] = "distance"
+    # Centered on 15,15: the top right layer is the nearest and the bottom left one the farthest.
+    params["q_geo"] = "[-50,-50 TO 80,80]"
+
+    response = client.get(catalog_search_api, params)
+    assert 200 == response.status_code
+    results = json.loads(response.content.decode('utf-8'))
+    identifiers = [doc['layer_identifier'] for doc in results['d.docs']]
+    assert len(layers_list) == len(identifiers)
+    assert '9eb27aec-15d0-47c5-bfea-5a5279f77394' == identifiers[0]
+    assert 'f28ad41b-b91f-4d5d-a7c3-4b17dfaa5170' == identifiers[-1]
+
+
+def test_d_docs_cursor(client):
+    params = default_params.copy()
+    params["d_docs_limit"] = 1
+    params["d_docs_sort"] = "time"
+    params["d_docs_cursor"] = "*"
+
+    if registry.es_major_version(registry.REGISTRY_SEARCH_URL) < 5:
+        response = client.get(catalog_search_api, params)
+        es_status, data = json.loads(response.content.decode('utf-8'))
+        assert 400 == es_status
+        assert 'Elasticsearch 5' in data['error']['msg']
+        return
+
+    identifiers = []
+    while params["d_docs_cursor"]:
+        response = client.get(catalog_search_api, params)
+        assert 200 == response.status_code
+        results = json.loads(response.content.decode('utf-8'))
+        identifiers.extend(doc['layer_identifier'] for doc in results['d.docs'])
+        params["d_docs_cursor"] = results['d.docs.cursor']
+    assert [layer['identifier'] for layer in reversed(layers_list)] == identifiers
+
+    params["d_docs_cursor"] = "not a cursor"
+    response = client.get(catalog_search_api, params)
+    assert 400 == response.status_code
+
+
+def test_export(client, monkeypatch):
+    export_url = '{0}export.ndjson'.format(catalog_search_api)
+    response = client.get(export_url, {'q_user': 'user_1'})
+    assert 200 == response.status_code
+    assert response.streaming
+    lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+    docs = [json.loads(line) for line in lines]
+    assert 2 == len(docs)
+    assert set(['user_1']) == set(doc['layer_originator'] for doc in docs)
+
+    response = client.get(export_url, HTTP_ACCEPT_ENCODING='gzip')
+    assert 'gzip' == response['Content-Encoding']
+    content = gzip.GzipFile(fileobj=io.BytesIO(b''.join(response.streaming_content))).read()
+    assert len(layers_list) == len(content.decode('utf-8').splitlines())
+
+    response = client.get('/catalog/notacatalog/api/export.ndjson')
+    assert 404 == response.status_code
+
+    # Query errors are reported before the response starts streaming.
+    response = client.get(export_url, {'q_text': 'title:('})
+    assert 400 == response.status_code
+    assert not response.streaming
+
+    # So is an unreachable Elasticsearch.
+    monkeypatch.setattr(registry, 'REGISTRY_SEARCH_URL', 'http://wrong.url:8000')
+    response = client.get(export_url)
+    assert 500 == response.status_code
+    assert 'error' in json.loads(response.content.decode('utf-8'))
+
+
+def test_d_docs_fields(client):
+    params = default_params.copy()
+    params["d_docs_limit"] = 100
+    params["d_docs_fields"] = "title,layer_identifier,bbox"
+    params["request_echo"] = 0
+
+    response = client.get(catalog_search_api, params)
+    assert 200 == response.status_code
+    results = json.loads(response.content.decode('utf-8'))
+    assert 'request_body' not in results and 'request_url' not in results
+    assert len(layers_list) == len(results['d.docs'])
+    for doc in results['d.docs']:
+        assert set(['title', 'layer_identifier', 'bbox']) == set(doc.keys())
+
+    params["d_docs_fields"] = " , "
+    response = client.get(catalog_search_api, params)
+    assert 400 == response.status_code
+
+
+def test_q_catalogs(client):
+    registry.create_index('test_other')
+    params = default_params.copy()
+    params["q_catalogs"] = "{0},test_other".format(catalog_slug)
+
+    response = client.get('/api', params)
+    assert 200 == response.status_code
+    results = json.loads(response.content.decode('utf-8'))
+    assert len(layers_list) == results['a.matchDocs']
+    counts = dict((item['value'], item['count']) for item in results['a.catalog']['counts'])
+    assert len(layers_list) == counts[catalog_slug]
+    assert 0 == counts.get('test_other', 0)
+    registry.delete_index('test_other')
+
+    params["q_catalogs"] = "a b"
+    response = client.get('/api', params)
+    assert 400 == response.status_code
+
+
+def test_batch_search(client):
+    searches = [
+        {'q_catalogs': catalog_slug, 'q_user': 'user_1'},
+        {'q.catalogs': catalog_slug, 'q.time': '[2002-01-01 TO *]', 'd.docs.limit': 10},
+        {'q_geo': '[-5,-5 5,5]'},
+        'not an object',
+        {'q_user': 'user_1', 'search_engine_endpoint': 'http://wrong.url:8000'},
+    ]
+    response = client.post('/api/batch', json.dumps(searches), content_type='application/json')
+    assert 200 == response.status_code
+    results = json.loads(response.content.decode('utf-8'))
+    assert 5 == len(results)
+    assert 2 == results[0]['a.matchDocs']
+    assert 2 == len(results[1]['d.docs'])
+    assert 400 == results[2][0]
+    assert 400 == results[3][0]
+    # Each search goes to its own endpoint, as with /api.
+    assert 500 == results[4][0]
+
+    response = client.post('/api/batch', 'not json', content_type='application/json')
+    assert 400 == response.status_code
+    response = client.get('/api/batch')
+    assert 405 == response.status_code
+
+
+def test_query_plan(client):
+    # Whole world and open time ranges match every document and are left out.
+    response = client.get(catalog_search_api, default_params)
+    assert 200 == response.status_code
+    results = json.loads(response.content.decode('utf-8'))
+    assert len(layers_list) == results['a.matchDocs']
+    assert 'geo_shape' not in results['request_body']
+    assert 'layer_date' not in results['request_body']
+    assert 'q_geo dropped, the whole world matches every document' in results['query_plan']
+
+    params = default_params.copy()
+    params["q_user"] = "user_1"
+    params["q_geo"] = "[-30,-30 TO 30,30]"
+    response = client.get(catalog_search_api, params)
+    results = json.loads(response.content.decode('utf-8'))
+    assert 2 == results['a.matchDocs']
+    assert 'filters ordered by cost: term, geo_shape' in results['query_plan']
+
+
 def test_q_time(client):
     params = default_params.copy()
     params["d_docs_limit"] = 100
@@ -498,6 +671,86 @@ def test_q_time(client):
     assert len(results["a.time"]["counts"]) == len(layers_list)
 
 
+def test_a_hm(client):
+    params = default_params.copy()
+    params["a_hm_limit"] = 100
+
+    response = client.get(catalog_search_api, params)
+    assert 200 == response.status_code
+    results = json.loads(response.content.decode('utf-8'))
+    heatmap = results['a.hm']
+    assert heatmap['columns'] * heatmap['rows'] <= 100
+    assert [-180, 180, -90, 90] == [heatmap['minX'], heatmap['maxX'], heatmap['minY'], heatmap['maxY']]
+    counts = [count for row in heatmap['counts_ints2D'] if row for count in row]
+    assert len(layers_list) == sum(counts)
+
+    # Only the top right layer is in the heatmap region.
+    params["a_hm_filter"] = "[0,0 TO 60,60]"
+    params["a_hm_gridlevel"] = 2
+    response = client.get(catalog_search_api, params)
+    results = json.loads(response.content.decode('utf-8'))
+    assert 2 == results['a.hm']['gridLevel']
+    counts = [count for row in results['a.hm']['counts_ints2D'] if row for count in row]
+    assert 1 == sum(counts)
+
+    params["a_hm_gridlevel"] = 13
+    response = client.get(catalog_search_api, params)
+    assert 400 == response.status_code
+
+
+def test_a_user_a_text(client):
+    params = default_params.copy()
+    params["a_user_limit"] = 10
+    params["a_text_limit"] = 5
+
+    response = client.get(catalog_search_api, params)
+    assert 200 == response.status_code
+    results = json.loads(response.content.decode('utf-8'))
+    users = dict((item['value'], item['count']) for item in results['a.user']['counts'])
+    assert {'user_1': 2, 'user_2': 2} == users
+    assert 0 < len(results['a.text']['counts']) <= 5
+
+
+def test_es_mapping(client):
+    # Every 5.x release maps text and keyword fields, with fielddata for the a.text facet.
+    for version in ('5.0.0', '5.6.16'):
+        properties = registry.es_mapping(version)['mappings']['layer']['properties']
+        assert {'type': 'text', 'fielddata': True} == properties['alltext']
+    properties = registry.es_mapping('2.4.6')['mappings']['layer']['properties']
+    assert {'type': 'string', 'index': 'analyzed'} == properties['alltext']
+
+    # Mappings are compared by type, strings of older releases count as text or keyword.
+    keyword = registry.es_mapping('5.6.16')['mappings']['layer']['properties']['layer_identifier']
+    assert registry.mapping_matches({'type': 'keyword'}, keyword)
+    assert registry.mapping_matches({'type': 'string', 'index': 'not_analyzed'}, keyword)
+    assert not registry.mapping_matches({'type': 'text'}, keyword)
+    alltext = registry.es_mapping('5.6.16')['mappings']['layer']['properties']['alltext']
+    assert not registry.mapping_matches({'type': 'text'}, alltext)
+    assert registry.mapping_matches({'type': 'string'}, properties['alltext'])
+
+
+def test_outdated_mapping(client):
+    # A catalog created before layer_centroid was mapped.
+    es_client = rawes.Elastic(registry.REGISTRY_SEARCH_URL)
+    mapping = registry.es_mapping(es_client.get('')['version']['number'])
+    del mapping['mappings']['layer']['properties']['layer_centroid']
+    es_client.put('legacy', data=mapping)
+    registry.MAPPING_CHECKS.discard_if(lambda key: True)
+
+    params = default_params.copy()
+    params["a_hm_limit"] = 100
+    response = client.get('/catalog/legacy/api/', params)
+    es_status, data = json.loads(response.content.decode('utf-8'))
+    assert 400 == es_status
+    assert 'Reindex legacy' in data['error']['msg']
+    assert 'layer_centroid' in data['error']['msg']
+
+    response = client.get('/catalog/legacy/api/', default_params)
+    assert 'a.matchDocs' in json.loads(response.content.decode('utf-8'))
+
+    registry.delete_index('legacy')
+
+
 def test_mapproxy(client):
     mapproxy_url = '/layer/f28ad41b-b91f-4d5d-a7c3-4b17dfaa5170.yml'
     response = client.get(mapproxy_url)
@@ -540,6 +793,143 @@ def test_mapproxy(client):
                    '%3A3857&format=image%2Fpng&wms_layer=layer_1+titleterm1'
     response = client.get(mapproxy_url)
     assert 200 == response.status_code
+    assert response.streaming
+    assert 'text/html' in response['Content-Type']
+
+
+def test_mapproxy_cache(client):
+    cache = registry.LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert 1 == cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert 3 == cache.get('c')
+    assert {'size': 2, 'maxsize': 2, 'bytes': 0, 'hits': 2, 'misses': 1, 'evictions': 1} == cache.stats()
+
+    # Repeated requests for a layer reuse the same MapProxy app.
+    layer = registry.layer_from_csw('f28ad41b-b91f-4d5d-a7c3-4b17dfaa5170')
+    app, _ = registry.get_mapproxy(layer)
+    same_app, _ = registry.get_mapproxy(layer)
+    assert app is same_app
+
+    response = client.get('/stats')
+    assert 200 == response.status_code
+    stats = json.loads(response.content.decode('utf-8'))
+    assert stats['mapproxy_apps']['hits'] >= 1
+
+
+def test_search_cache(client, tmpdir):
+    cache = registry.LRUCache(10, ttl=60, maxbytes=10)
+    cache.set('a', 'x' * 6)
+    cache.set('b', 'x' * 6)
+    assert cache.get('a') is None
+    assert 6 == cache.stats()['bytes']
+
+    for url in ('memory', 'sqlite:///{0}'.format(tmpdir.join('search.db'))):
+        search_cache = registry.SearchCache(url, 60, 1024)
+        key = search_cache.key({'q_text': 'water'}, 'catalog_a')
+        assert key == search_cache.key({'q_text': 'water'}, 'catalog_a')
+        assert key != search_cache.key({'q_text': 'water'}, 'catalog_b')
+        search_cache.set(key, '{}')
+        assert '{}' == search_cache.get(key)
+        assert 1 == search_cache.stats()['hits']
+
+        # Indexing into a catalog changes the key of its searches, and of searches across all catalogs.
+        all_key = search_cache.key({'q_text': 'water'}, None)
+        search_cache.bump('catalog_a')
+        assert search_cache.key({'q_text': 'water'}, 'catalog_a') is None
+        assert search_cache.key({'q_text': 'water'}, None) is None
+        assert search_cache.key({'q_text': 'water'}, 'catalog_b') is not None
+        time.sleep(registry.REGISTRY_SEARCH_CACHE_SETTLE)
+        assert search_cache.key({'q_text': 'water'}, 'catalog_a') not in (None, key)
+        assert search_cache.key({'q_text': 'water'}, None) not in (None, all_key)
+
+    response = client.get('/stats')
+    stats = json.loads(response.content.decode('utf-8'))
+    assert 'search_responses' in stats
+
+
+def test_tile_cache(client, tmpdir, monkeypatch):
+    monkeypatch.setattr(registry, 'REGISTRY_TILE_CACHE_DIR', str(tmpdir))
+    monkeypatch.setitem(registry.TILE_CACHE_STATE, 'pruned', time.time())
+
+    assert 'directory' in registry.tile_cache_config('layer_a')
+    assert not registry.refresh_tile_cache('layer_a', '2000-03-01', force=True)
+    tmpdir.join('layer_a', 'tile.png').write('x' * 100)
+    assert not registry.refresh_tile_cache('layer_a', '2000-03-01', force=True)
+    assert tmpdir.join('layer_a', 'tile.png').check()
+
+    # A new modification date purges the tiles.
+    assert registry.refresh_tile_cache('layer_a', '2001-03-01', force=True)
+    assert not tmpdir.join('layer_a', 'tile.png').check()
+
+    # The least recently used layer is evicted first.
+    tmpdir.join('layer_a', 'tile.png').write('x' * 100)
+    registry.refresh_tile_cache('layer_b', '2000-03-01', force=True)
+    tmpdir.join('layer_b', 'tile.png').write('x' * 100)
+    os.utime(str(tmpdir.join('layer_a', '.accessed')), (0, 0))
+    assert registry.prune_tile_cache(max_bytes=150) > 0
+    assert not tmpdir.join('layer_a').check()
+    assert tmpdir.join('layer_b', 'tile.png').check()
+
+    # Purging a layer also releases its MapProxy apps, which hold the cache files open.
+    registry.MAPPROXY_APPS.set(('layer_b', '2000-03-01'), (None, None, None))
+    registry.MAPPROXY_APPS.set(('layer_c', '2000-03-01'), (None, None, None))
+    registry.purge_tile_cache('layer_b')
+    assert registry.MAPPROXY_APPS.get(('layer_b', '2000-03-01')) is None
+    assert registry.MAPPROXY_APPS.get(('layer_c', '2000-03-01')) is not None
+    registry.MAPPROXY_APPS.discard(('layer_c', '2000-03-01'))
+
+    # Concurrent first requests for a layer may all create its directory.
+    registry.ensure_directory(str(tmpdir.join('layer_d')))
+    registry.ensure_directory(str(tmpdir.join('layer_d')))
+    assert tmpdir.join('layer_d').check(dir=True)
+
+
+def test_thumbnail_store(client, tmpdir, monkeypatch):
+    monkeypatch.setattr(registry, 'REGISTRY_THUMBNAIL_DIR', str(tmpdir))
+
+    layer_uuid = 'f28ad41b-b91f-4d5d-a7c3-4b17dfaa5170'
+    layer = registry.layer_from_csw(layer_uuid)
+    registry.store_thumbnail(layer, b'stored png')
+    assert b'stored png' == registry.get_thumbnail(layer)
+    assert tmpdir.join(layer_uuid, '{0}.png'.format(registry.thumbnail_etag(layer))).check()
+
+    # Storing a new version of the record drops the older thumbnail of that layer only.
+    tmpdir.join(layer_uuid, 'old.png').write('old png')
+    tmpdir.join('other', 'old.png').write('other png', ensure=True)
+    registry.store_thumbnail(layer, b'stored png')
+    assert not tmpdir.join(layer_uuid, 'old.png').check()
+    assert tmpdir.join('other', 'old.png').check()
+
+    mapproxy_url = '/layer/{0}.png'.format(layer_uuid)
+    response = client.get(mapproxy_url)
+    assert 200 == response.status_code
+    assert b'stored png' == response.content
+    etag = response['ETag']
+    assert registry.thumbnail_etag(layer) in etag
+    assert 'Last-Modified' in response
+
+    response = client.get(mapproxy_url, HTTP_IF_NONE_MATCH=etag)
+    assert 304 == response.status_code
+
+    response = client.get(mapproxy_url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+    assert 304 == response.status_code
+
+    # Pre-rendering bounds the upstream requests of the render.
+    _, extra_config, _ = registry.build_mapproxy(layer, client_timeout=5)
+    assert 5 == extra_config['globals']['http']['client_timeout']
+
+    # Pre-rendering skips thumbnails already in the store.
+    for item in layers_list:
+        registry.store_thumbnail(registry.layer_from_csw(item['identifier']), b'stored png')
+    summary = registry.render_thumbnails(catalog=catalog_slug, threads=2)
+    assert len(layers_list) == summary['skipped']
+    assert 0 == summary['failed'] + summary['timeout']
+
+    summary = registry.render_thumbnails(since='2002-01-01')
+    assert 2 == summary['skipped']
 
 
 def test_vcaps(client):
@@ -610,6 +1000,92 @@ def test_utilities(client):
     assert 'Failed to establish a new connection' in str(excinfo.value)
 
 
+def test_repository_template(client):
+    first, second = registry.RegistryRepository(), registry.RegistryRepository()
+    assert first.engine is second.engine
+    assert first.dataset is second.dataset
+    assert first.context is second.context
+    assert first.session is not second.session
+    assert first.engine is registry.Repository._engines[registry.PYCSW['repository']['database']]
+
+    layer = registry.layer_from_csw('f28ad41b-b91f-4d5d-a7c3-4b17dfaa5170')
+    assert 'f28ad41b-b91f-4d5d-a7c3-4b17dfaa5170' == layer.identifier
+
+
+def test_record_cache(client):
+    layer_uuid = 'f28ad41b-b91f-4d5d-a7c3-4b17dfaa5170'
+    registry.RECORDS.discard(layer_uuid)
+    layer = registry.layer_from_csw(layer_uuid)
+    assert layer is registry.layer_from_csw(layer_uuid)
+
+    # Unknown uuids are remembered for a while.
+    missing_uuid = 'f28ad41b-b91f-4d5d-a7c3-4b17dfaa5179'
+    assert registry.layer_from_csw(missing_uuid) is None
+    assert registry.MISSING_RECORDS.get(missing_uuid)
+
+    # Inserting a record drops its cached versions.
+    registry.RegistryRepository().invalidate(layer)
+    assert registry.RECORDS.get(layer_uuid) is None
+    assert layer is not registry.layer_from_csw(layer_uuid)
+
+    response = client.get('/stats')
+    stats = json.loads(response.content.decode('utf-8'))
+    assert stats['records']['hits'] >= 1
+    assert 'missing_records' in stats
+
+
+def test_layer_batch(client):
+    layer_uuids = [layer['identifier'] for layer in layers_list[:2]]
+    missing_uuid = 'f28ad41b-b91f-4d5d-a7c3-4b17dfaa5179'
+    apps = registry.MAPPROXY_APPS.stats()
+    response = client.get('/layer/batch', {'ids': ','.join(layer_uuids + [missing_uuid])})
+    assert 200 == response.status_code
+    # Configurations are built without MapProxy apps, the apps serving tiles stay cached.
+    assert apps == registry.MAPPROXY_APPS.stats()
+    configs = json.loads(response.content.decode('utf-8'))
+    assert set(layer_uuids + [missing_uuid]) == set(configs.keys())
+    assert 'layers' in configs[layer_uuids[0]]
+    assert configs[missing_uuid] is None
+
+    response = client.post('/layer/batch', {'ids': ','.join(layer_uuids), 'format': 'xml'})
+    assert 200 == response.status_code
+    for layer_uuid in layer_uuids:
+        assert layer_uuid in response.content.decode('utf-8')
+
+    response = client.get('/layer/batch', {'ids': 'not-a-uuid'})
+    assert 400 == response.status_code
+
+
+def test_es_connect(client):
+    es, version = registry.es_connect(registry.REGISTRY_SEARCH_URL)
+    same_es, same_version = registry.es_connect(registry.REGISTRY_SEARCH_URL)
+    assert es is same_es
+    assert version == same_version
+    assert registry.es_major_version(registry.REGISTRY_SEARCH_URL) == int(version.split('.')[0])
+
+    registry.es_disconnect(registry.REGISTRY_SEARCH_URL)
+    new_es, _ = registry.es_connect(registry.REGISTRY_SEARCH_URL)
+    assert new_es is not es
+    assert registry.es_major_version('http://localhost:9500') == 2
+
+
+def test_catalog_cache(client):
+    registry.create_index('cached')
+    assert 'cached' in registry.CATALOGS.names()
+    assert registry.check_index_exists('cached')
+
+    registry.delete_index('cached')
+    assert 'cached' not in registry.CATALOGS.names()
+    assert not registry.check_index_exists('cached')
+
+    # Catalogs created behind the cache are found by a resync.
+    es_client = rawes.Elastic(registry.REGISTRY_SEARCH_URL)
+    es_client.put('/external')
+    assert 'external' not in registry.CATALOGS.names()
+    assert registry.check_index_exists('external')
+    registry.delete_index('external')
+
+
 def test_bad_mapproxy_config(client):
     with pytest.raises(registry.ConfigurationError) as excinfo:
         registry.configure_mapproxy({}, ignore_warnings=False)
@@ -689,5 +1165,134 @@ def test_load_records(client):
 
     test_clear_records(client)
 
+
+def test_bulk_index(client, monkeypatch):
+    test_create_catalog(client)
+
+    repository = registry.RegistryRepository()
+    repository.catalog = catalog_slug
+    context = config.StaticContext()
+    xml_records = etree.fromstring(construct_payload(layers_list=layers_list))
+    records = xml_records.xpath('//csw:Insert/child::*', namespaces=context.namespaces)
+    records = [registry.metadata.parse_record(context, r, repository)[0] for r in records]
+
+    # Records are buffered until the batch is full.
+    monkeypatch.setattr(registry, 'REGISTRY_INDEX_BATCH_SIZE', len(layers_list) - 1)
+    [repository.insert(r, 'local', r.insert_date) for r in records]
+    monkeypatch.undo()
+    assert 1 == len(repository.es_buffer)
+    assert repository in registry.PENDING_REPOSITORIES
+
+    assert 1 == repository.flush()
+    assert 0 == len(repository.es_buffer)
+    assert 0 == repository.flush()
+
+    es_client = rawes.Elastic(registry.REGISTRY_SEARCH_URL)
+    es_client.post('/_refresh')
+    response = client.get(catalog_search_api)
+    search_response = json.loads(response.content.decode('utf-8'))
+    assert len(layers_list) == search_response['a.matchDocs']
+
+    test_clear_records(client)
+
+
+def test_reindex(client):
+    test_create_catalog(client)
+    payload = construct_payload(layers_list=layers_list)
+    client.post('/catalog/{0}/csw'.format(catalog_slug), payload, content_type='text/xml')
+
+    summary = registry.reindex(catalog_slug, chunk_size=2)
+    assert len(layers_list) == summary['records']
+    assert len(layers_list) == summary['indexed']
+    assert summary['replaced']
+
+    # The catalog is now an alias of the new index.
+    es_client = rawes.Elastic(registry.REGISTRY_SEARCH_URL)
+    aliases = es_client.get('_aliases')
+    assert catalog_slug not in aliases
+    assert catalog_slug in aliases[summary['index']]['aliases']
+    assert [catalog_slug] == registry.CATALOGS.names()
+    response = client.get(catalog_search_api)
+    search_response = json.loads(response.content.decode('utf-8'))
+    assert len(layers_list) == search_response['a.matchDocs']
+
+    # Catalog facets name the catalog, not the index behind its alias.
+    params = default_params.copy()
+    params["q_catalogs"] = catalog_slug
+    response = client.get('/api', params)
+    results = json.loads(response.content.decode('utf-8'))
+    counts = dict((item['value'], item['count']) for item in results['a.catalog']['counts'])
+    assert {catalog_slug: len(layers_list)} == counts
+
+    # Only the records of the catalog are reindexed into it.
+    registry.create_index('other')
+    repository = registry.RegistryRepository()
+    repository.catalog = 'other'
+    repository.index(registry.layer_from_csw(layers_list[0]['identifier']))
+    repository.flush()
+    es_client.post('/_refresh')
+    summary = registry.reindex('other')
+    assert 1 == summary['records']
+    assert summary['replaced']
+    registry.delete_index('other')
+
+    with pytest.raises(ValueError):
+        registry.reindex('missing')
+
+    test_clear_records(client)
+
+
+def test_load_records_parallel(client, tmpdir):
+    test_create_catalog(client)
+
+    files_names = []
+    for i, layer in enumerate(layers_list):
+        xml_file = tmpdir.join('records_{0}.xml'.format(i))
+        xml_file.write(construct_payload(layers_list=[layer]))
+        files_names.append(str(xml_file))
+    broken_file = tmpdir.join('broken.xml')
+    broken_file.write('<csw:Transaction>')
+    files_names.append(str(broken_file))
+
+    summary = registry.load_records_parallel(catalog_slug, files_names, 2)
+    assert len(files_names) == summary['files']
+    assert len(layers_list) == summary['records']
+    assert 1 == len(summary['errors'])
+
+    es_client = rawes.Elastic(registry.REGISTRY_SEARCH_URL)
+    es_client.post('/_refresh')
+    response = client.get(catalog_search_api)
+    search_response = json.loads(response.content.decode('utf-8'))
+    assert len(layers_list) == search_response['a.matchDocs']
+
+    test_clear_records(client)
+
+
+def test_load_records_stream(client, tmpdir):
+    test_create_catalog(client)
+
+    repository = registry.RegistryRepository()
+    repository.catalog = catalog_slug
+    xml_file = tmpdir.join('records.xml')
+    xml_file.write(construct_payload(layers_list=layers_list))
+    context = config.StaticContext()
+
+    assert len(layers_list) == registry.load_records_stream(repository, str(xml_file), context)
+    assert 0 == len(repository.es_buffer)
+
+    # Records already in the database are reported, not silently dropped.
+    errors = []
+    assert 0 == registry.load_records_stream(repository, str(xml_file), context, errors)
+    assert len(layers_list) == len(errors)
+
+    es_client = rawes.Elastic(registry.REGISTRY_SEARCH_URL)
+    es_client.post('/_refresh')
+    assert len(layers_list) == int(repository.query('')[0])
+    response = client.get(catalog_search_api)
+    search_response = json.loads(response.content.decode('utf-8'))
+    assert len(layers_list) == search_response['a.matchDocs']
+
+    test_clear_records(client)
+
 if __name__ == '__main__':
     pytest.main()